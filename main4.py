@@ -1,61 +1,2513 @@
+import time
+_import_started = time.perf_counter()
+
 import os
 import sys
-import shlex
 import json
 import base64
-import calendar
-from typing import List, Dict, Optional
+import codecs
+import importlib
+import re
+import struct
+import _thread
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from json.decoder import scanstring
+from typing import List, Dict, Optional, Union
+
+
+# Кодировки листьев VFS, которые хранятся в памяти как есть и декодируются при чтении.
+# JSON не может нести сырые байты, поэтому 'zlib' - то же, что 'zlib+base64'.
+LAZY_ENCODINGS = ('base64', 'zlib', 'zlib+base64')
+COMPRESSED_ENCODINGS = ('zlib', 'zlib+base64')
+# Размер блока при потоковом чтении содержимого файлов
+CHUNK_SIZE = 64 * 1024
+# Символы вне алфавита base64 (переносы строк base64.encodebytes и т.п.) b64decode пропускает
+BASE64_JUNK_RE = re.compile(r'[^A-Za-z0-9+/=]+')
+
+
+# Время импорта модулей, загруженных по требованию (для --startup-profile)
+import_profile = {}
+
+
+def lazy_import(module_name: str):
+    """Импортирует модуль при первом использовании: calendar нужен только cal,
+    пул процессов - только build-vfs и batch, mmap - бинарным образам, zlib - сжатому
+    содержимому, hashlib - дедупликации при загрузке JSON, stat - каталогам хост-системы"""
+    module = sys.modules.get(module_name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        import_profile[module_name] = time.perf_counter() - started
+    return module
+
+
+def content_to_bytes(value) -> bytes:
+    """Содержимое файла в байтах; нестроковые значения из JSON - в их текстовом виде"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+class LazyContent:
+    """Содержимое файла в закодированном (возможно, сжатом) виде, декодируется только при чтении"""
+    __slots__ = ('raw', 'encoding')
+
+    def __init__(self, raw: Union[str, memoryview], encoding: str):
+        self.raw = raw
+        self.encoding = encoding
+
+    def decode(self) -> bytes:
+        if self.encoding == 'base64':
+            return base64.b64decode(self.raw)
+        if self.encoding in COMPRESSED_ENCODINGS:
+            data = self.raw if isinstance(self.raw, memoryview) else base64.b64decode(self.raw)
+            return lazy_import('zlib').decompress(data)
+        return content_to_bytes(self.raw)
+
+    def _iter_raw(self, chunk_size: int):
+        """Хранимые (ещё не распакованные) байты блоками; base64 декодируется по частям"""
+        if isinstance(self.raw, memoryview):
+            for start in range(0, len(self.raw), chunk_size):
+                yield self.raw[start:start + chunk_size]
+            return
+        # Блок base64 кратен 4 значащим символам, чтобы декодироваться независимо;
+        # остаток после удаления переносов строк переходит в следующий блок
+        step = max(4, chunk_size // 3 * 4)
+        carry = ''
+        for start in range(0, len(self.raw), step):
+            piece = carry + self.raw[start:start + step]
+            if BASE64_JUNK_RE.search(piece) is not None:
+                piece = BASE64_JUNK_RE.sub('', piece)
+            cut = len(piece) - len(piece) % 4
+            carry = piece[cut:]
+            if cut:
+                yield base64.b64decode(piece[:cut])
+        if carry:
+            yield base64.b64decode(carry)
+
+    def iter_decode(self, chunk_size: int = CHUNK_SIZE):
+        """Декодированное содержимое блоками не больше chunk_size, без сборки целого значения"""
+        if self.encoding not in LAZY_ENCODINGS:
+            data = self.decode()
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+            return
+        if self.encoding == 'base64':
+            yield from self._iter_raw(chunk_size)
+            return
+        decompressor = lazy_import('zlib').decompressobj()
+        for block in self._iter_raw(chunk_size):
+            data = decompressor.decompress(block, chunk_size)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+    def stored_size(self) -> int:
+        return len(self.raw)
+
+    def size(self) -> int:
+        """Размер декодированного содержимого; сжатое распаковывается потоково, без сборки"""
+        if self.encoding == 'base64' and isinstance(self.raw, str) and len(self.raw) % 4 == 0 \
+                and BASE64_JUNK_RE.search(self.raw) is None:
+            return len(self.raw) // 4 * 3 - self.raw[-2:].count('=')
+        if self.encoding in COMPRESSED_ENCODINGS:
+            return sum(len(chunk) for chunk in self.iter_decode())
+        return len(self.decode())
+
+
+class DecodeCache:
+    """LRU-кэш декодированного содержимого, ограниченный суммарным размером.
+
+    Кэш общий для всех сеансов над образом, в том числе сеансов serve из разных
+    потоков, поэтому изменения списка под блокировкой; декодирование - вне её.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.decodes = 0
+        self.hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = _thread.allocate_lock()
+
+    def peek(self, handle: LazyContent) -> Optional[bytes]:
+        """Закэшированное значение или None; не декодирует, попадание учитывается в hits"""
+        with self._lock:
+            value = self._entries.get(handle)
+            if value is not None:
+                self._entries.move_to_end(handle)
+                self.hits += 1
+        return value
+
+    def get(self, handle: LazyContent) -> bytes:
+        value = self.peek(handle)
+        if value is not None:
+            return value
+
+        value = handle.decode()
+        size = len(value)
+        with self._lock:
+            self.decodes += 1
+            if size <= self.max_bytes and handle not in self._entries:
+                self._entries[handle] = value
+                self.used += size
+                while self.used > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.used -= len(evicted)
+                    self.evictions += 1
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_stats(self) -> Dict[str, object]:
+        requests = self.hits + self.decodes
+        return {
+            'cache_entries': len(self._entries),
+            'cache_bytes': self.used,
+            'cache_limit': self.max_bytes,
+            'cache_hits': self.hits,
+            'cache_decodes': self.decodes,
+            'cache_evictions': self.evictions,
+            'cache_hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+        }
+
+
+class BlobStore:
+    """Контентно-адресуемое хранилище: одинаковое содержимое хранится один раз.
+
+    Ключ - хэш содержимого; файлы с одинаковым содержимым ссылаются на один блоб.
+    """
+
+    def __init__(self):
+        self._blobs = {}
+        self.refs = 0
+        self.bytes_total = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def digest(data: bytes) -> bytes:
+        return lazy_import('hashlib').blake2b(data, digest_size=16).digest()
+
+    def intern(self, key: bytes, size: int, make_blob):
+        """Блоб по ключу; make_blob() вызывается, только если такого содержимого ещё нет"""
+        self.refs += 1
+        self.bytes_total += size
+        blob = self._blobs.get(key)
+        if blob is not None:
+            self.bytes_saved += size
+            return blob
+        blob = make_blob()
+        self._blobs[key] = blob
+        return blob
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def get_stats(self) -> Dict[str, object]:
+        stored = self.bytes_total - self.bytes_saved
+        return {
+            'blob_refs': self.refs,
+            'blob_unique': len(self._blobs),
+            'dedup_bytes_saved': self.bytes_saved,
+            'dedup_ratio': round(self.bytes_total / stored, 2) if stored else 1.0,
+        }
+
+
+class JsonTokenizer:
+    """Инкрементальный токенизатор JSON, читающий поток байтов блоками"""
+
+    NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+    NUMBER_CHARS_RE = re.compile(r'[-+0-9.eE]+')
+    LITERALS = {'true': True, 'false': False, 'null': None}
+
+    def __init__(self, stream, chunk_size: int = 64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        # Если токен обрывается на границе блока, дочитываем не меньше уже
+        # накопленного хвоста, чтобы длинные строки сканировались за линейное время
+        size = max(self.chunk_size, len(self.buf) - self.pos)
+        chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        if chunk:
+            text = self.decoder.decode(chunk)
+        else:
+            text = self.decoder.decode(b'', final=True)
+            self.eof = True
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"Некорректный JSON (байт ~{self.bytes_read}): {message}")
+
+    def __iter__(self):
+        while True:
+            buf = self.buf
+            pos = self.pos
+            end = len(buf)
+            while pos < end and buf[pos] in ' \t\n\r':
+                pos += 1
+            self.pos = pos
+            if pos >= end:
+                if not self._fill():
+                    return
+                continue
+
+            ch = buf[pos]
+            if ch in '{}[]:,':
+                self.pos = pos + 1
+                yield ch, None
+            elif ch == '"':
+                try:
+                    value, self.pos = scanstring(buf, pos + 1)
+                except ValueError as e:
+                    if not self._fill():
+                        raise self._error(str(e))
+                    continue
+                yield 'str', value
+            else:
+                span = self.NUMBER_CHARS_RE.match(buf, pos)
+                if span:
+                    if span.end() >= end and self._fill():
+                        continue
+                    match = self.NUMBER_RE.fullmatch(span.group())
+                    if not match:
+                        raise self._error(f"некорректное число {span.group()!r}")
+                    self.pos = span.end()
+                    integer = not (match.group(1) or match.group(2))
+                    yield 'value', int(span.group()) if integer else float(span.group())
+                    continue
+                for literal, value in self.LITERALS.items():
+                    if buf.startswith(literal, pos):
+                        self.pos = pos + len(literal)
+                        yield 'value', value
+                        break
+                else:
+                    if end - pos < 5 and self._fill():
+                        continue
+                    raise self._error(f"неожиданный символ {ch!r}")
+
+
+KIND_DIR = 0
+KIND_FILE = 1
+
+
+class DirEntries:
+    """Отсортированный по имени индекс детей каталога: имена и иноды в параллельных массивах.
+
+    add() дописывает в конец без сортировки (для массовой загрузки), порядок
+    восстанавливается при первом чтении; insert() и remove() поддерживают
+    порядок инкрементально.
+    """
+    __slots__ = ('names', 'inodes', 'ordered')
+    # Образ общий для сеансов serve, и первая сортировка может начаться в нескольких
+    # потоках сразу; уже упорядоченные каталоги блокировку не берут
+    _sort_lock = _thread.allocate_lock()
+
+    def __init__(self):
+        self.names = []
+        self.inodes = array('I')
+        self.ordered = True
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, ino: int):
+        if self.names and name <= self.names[-1]:
+            self.ordered = False
+        self.names.append(name)
+        self.inodes.append(ino)
+
+    def _ensure_sorted(self):
+        if self.ordered:
+            return
+        with self._sort_lock:
+            if self.ordered:
+                return
+            # Сортировка устойчивая: из повторяющихся имён остаётся последнее добавленное
+            pairs = sorted(zip(self.names, self.inodes), key=lambda pair: pair[0])
+            names = []
+            inodes = array('I')
+            for name, ino in pairs:
+                if names and names[-1] == name:
+                    inodes[-1] = ino
+                else:
+                    names.append(name)
+                    inodes.append(ino)
+            self.names = names
+            self.inodes = inodes
+            self.ordered = True
+
+    def get(self, name: str) -> Optional[int]:
+        self._ensure_sorted()
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return self.inodes[i]
+        return None
+
+    def insert(self, name: str, ino: int) -> Optional[int]:
+        """Добавляет или заменяет запись; возвращает вытесненный инод"""
+        self._ensure_sorted()
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            replaced = self.inodes[i]
+            self.inodes[i] = ino
+            return replaced
+        self.names.insert(i, name)
+        self.inodes.insert(i, ino)
+        return None
+
+    def remove(self, name: str) -> Optional[int]:
+        self._ensure_sorted()
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+            return self.inodes.pop(i)
+        return None
+
+    def slice_names(self, start: int = 0, stop: int = None):
+        self._ensure_sorted()
+        names = self.names
+        stop = len(names) if stop is None else min(stop, len(names))
+        return (names[i] for i in range(start, stop))
+
+    def all_inodes(self) -> array:
+        self._ensure_sorted()
+        return self.inodes
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.names) + sys.getsizeof(self.inodes)
+
+
+class InodeTable:
+    """Таблица инодов в памяти: параллельные массивы вместо вложенных словарей.
+
+    Инод - индекс в массивах. Каталог хранит отсортированный индекс детей
+    DirEntries, файл - своё содержимое. Инод 0 - корневой каталог.
+    """
+    ROOT = 0
+
+    def __init__(self):
+        self.kinds = bytearray()
+        self.names = []
+        self.parents = array('I')
+        self.data = []
+        self._append(KIND_DIR, '', self.ROOT, DirEntries())
+
+    def _append(self, kind: int, name: str, parent: int, data) -> int:
+        ino = len(self.kinds)
+        self.kinds.append(kind)
+        self.names.append(sys.intern(name))
+        self.parents.append(parent)
+        self.data.append(data)
+        return ino
+
+    def _link(self, parent: int, name: str, kind: int, data) -> int:
+        ino = self._append(kind, name, parent, data)
+        self.data[parent].add(self.names[ino], ino)
+        return ino
+
+    def add_dir(self, parent: int, name: str) -> int:
+        return self._link(parent, name, KIND_DIR, DirEntries())
+
+    def add_file(self, parent: int, name: str, content) -> int:
+        return self._link(parent, name, KIND_FILE, content)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def is_dir(self, ino: int) -> bool:
+        return self.kinds[ino] == KIND_DIR
+
+    def name(self, ino: int) -> str:
+        return self.names[ino]
+
+    def parent(self, ino: int) -> int:
+        return self.parents[ino]
+
+    def lookup(self, ino: int, name: str) -> Optional[int]:
+        if self.kinds[ino] != KIND_DIR:
+            return None
+        return self.data[ino].get(name)
+
+    def children(self, ino: int):
+        if self.kinds[ino] != KIND_DIR:
+            return ()
+        return self.data[ino].all_inodes()
+
+    def child_count(self, ino: int) -> int:
+        return len(self.data[ino]) if self.kinds[ino] == KIND_DIR else 0
+
+    def child_names(self, ino: int, start: int = 0, stop: int = None):
+        """Имена детей в отсортированном порядке, без пересортировки"""
+        if self.kinds[ino] != KIND_DIR:
+            return iter(())
+        return self.data[ino].slice_names(start, stop)
+
+    def content(self, ino: int):
+        return self.data[ino]
+
+    def size(self, ino: int) -> int:
+        return _content_size(self.data[ino])
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Оценка занимаемой памяти: структура дерева отдельно от содержимого файлов"""
+        structure = (sys.getsizeof(self.kinds) + sys.getsizeof(self.names)
+                     + sys.getsizeof(self.parents) + sys.getsizeof(self.data))
+        content = 0
+        seen_names = set()
+        for name in self.names:
+            if id(name) not in seen_names:
+                seen_names.add(id(name))
+                structure += sys.getsizeof(name)
+        for kind, item in zip(self.kinds, self.data):
+            if kind == KIND_DIR:
+                structure += item.memory_usage()
+            elif isinstance(item, LazyContent):
+                structure += sys.getsizeof(item)
+                content += sys.getsizeof(item.raw)
+            else:
+                content += sys.getsizeof(item)
+        return {'structure': structure, 'content': content}
+
+
+class _JsonFrame:
+    """Открытый контейнер при потоковом разборе JSON"""
+    __slots__ = ('mode', 'container', 'key', 'expect', 'items', 'ino', 'parent', 'name')
+
+    def __init__(self, mode: str, is_object: bool, parent: int = 0, name: str = ''):
+        self.mode = mode
+        self.container = {} if is_object else []
+        self.key = None
+        self.expect = 'key' if is_object else 'value'
+        self.items = 0
+        self.ino = None
+        self.parent = parent
+        self.name = name
+
+
+class StreamingJsonLoader:
+    """Строит таблицу инодов VFS за один проход по потоку токенов, без промежуточного json-дерева.
+
+    Объект внутри каталога становится каталогом, как только в нём встречается
+    вложенный объект; до этого его скалярные поля копятся, чтобы распознать
+    лист {"content": ..., "encoding": ...}.
+    """
+
+    def __init__(self, make_leaf, chunk_size: int = 64 * 1024):
+        self.make_leaf = make_leaf
+        self.chunk_size = chunk_size
+        self.table = InodeTable()
+        self.blobs = BlobStore()
+        self.bytes_read = 0
+        self.lazy_files = 0
+        self.compressed_files = 0
+        self.compressed_bytes = 0
+
+    def _scalar_leaf(self, value) -> bytes:
+        """Содержимое файла-скаляра, общее для всех одинаковых файлов образа"""
+        data = content_to_bytes(value)
+        # Двоеточие отделяет эти ключи от "кодировка:содержимое" листьев-объектов
+        return self.blobs.intern(BlobStore.digest(b':' + data), len(data), lambda: data)
+
+    def _materialize(self, frame: _JsonFrame):
+        frame.ino = self.table.add_dir(frame.parent, frame.name)
+        for key, value in frame.container.items():
+            self.table.add_file(frame.ino, key, self._scalar_leaf(value))
+        frame.container.clear()
+
+    def _attach(self, frame: _JsonFrame, value):
+        if frame.mode == 'raw':
+            if isinstance(frame.container, list):
+                frame.container.append(value)
+            else:
+                frame.container[frame.key] = value
+        elif frame.mode == 'node':
+            if frame.ino is None:
+                frame.container[frame.key] = value
+            else:
+                self.table.add_file(frame.ino, frame.key, self._scalar_leaf(value))
+
+    def _close_node(self, frame: _JsonFrame):
+        if frame.ino is not None:
+            return
+        pending = frame.container
+        if 'content' in pending and 'encoding' in pending:
+            raw = f"{pending['encoding']}:{pending['content']}".encode('utf-8')
+            before = len(self.blobs)
+            leaf = self.blobs.intern(BlobStore.digest(raw), len(raw), lambda: self.make_leaf(pending))
+            if isinstance(leaf, LazyContent) and len(self.blobs) > before:
+                self.lazy_files += 1
+                if leaf.encoding in COMPRESSED_ENCODINGS:
+                    self.compressed_files += 1
+                    self.compressed_bytes += leaf.stored_size()
+            self.table.add_file(frame.parent, frame.name, leaf)
+        else:
+            self._materialize(frame)
+
+    def load(self, stream) -> InodeTable:
+        tokens = JsonTokenizer(stream, self.chunk_size)
+        done = False
+        has_root = False
+        stack = []
+
+        for kind, value in tokens:
+            if done:
+                raise tokens._error("лишние данные после корневого значения")
+            top = stack[-1] if stack else None
+            expect = top.expect if top is not None else 'value'
+
+            if kind == ',':
+                if expect != ',':
+                    raise tokens._error("неожиданная ','")
+                top.expect = 'key' if isinstance(top.container, dict) else 'value'
+                continue
+            if kind == ':':
+                if expect != ':':
+                    raise tokens._error("неожиданное ':'")
+                top.expect = 'value'
+                continue
+            if expect == 'key':
+                if kind == 'str':
+                    top.key = value
+                    top.expect = ':'
+                    continue
+                if kind != '}' or top.items:
+                    raise tokens._error("ожидался ключ объекта")
+            elif kind in '}]':
+                if expect != ',' and not (kind == ']' and not top.items):
+                    raise tokens._error(f"неожиданная '{kind}'")
+            elif expect != 'value':
+                raise tokens._error(f"ожидался '{expect}'")
+
+            if kind in '{[':
+                is_object = kind == '{'
+                if top is None:
+                    frame = _JsonFrame('wrapper' if is_object else 'raw', is_object)
+                elif is_object and top.mode == 'wrapper' and top.key == '/':
+                    frame = _JsonFrame('node', True)
+                    frame.ino = InodeTable.ROOT
+                    has_root = True
+                elif is_object and top.mode == 'node':
+                    if top.ino is None:
+                        self._materialize(top)
+                    frame = _JsonFrame('node', True, top.ino, top.key)
+                else:
+                    frame = _JsonFrame('raw', is_object)
+                stack.append(frame)
+                continue
+
+            if kind in '}]':
+                if isinstance(top.container, dict) != (kind == '}'):
+                    raise tokens._error(f"неожиданная '{kind}'")
+                stack.pop()
+                if top.mode == 'node':
+                    self._close_node(top)
+                value = top.container if top.mode == 'raw' else None
+                if top.mode != 'raw' or not stack:
+                    if not stack:
+                        done = True
+                    else:
+                        stack[-1].expect = ','
+                        stack[-1].items += 1
+                    continue
+
+            if not stack:
+                done = True
+                continue
+            self._attach(stack[-1], value)
+            stack[-1].expect = ','
+            stack[-1].items += 1
+
+        if not done:
+            raise tokens._error("неожиданный конец файла")
+        if not has_root:
+            raise ValueError("в образе VFS нет корневого каталога '/'")
+        self.bytes_read = tokens.bytes_read
+        return self.table
+
+
+class VfsImage:
+    """Скомпилированный бинарный образ VFS, открываемый через mmap.
+
+    Формат: заголовок, таблица узлов, таблица имён и область содержимого.
+    Дети каталога лежат в таблице узлов подряд и отсортированы по имени.
+    """
+    MAGIC = b'VFSI'
+    VERSION = 2
+    # magic, версия, флаги, число узлов, смещение и размер таблицы имён,
+    # смещение и размер области содержимого
+    HEADER = struct.Struct('<4sHHIQQQQ')
+    # тип, кодировка, резерв, родитель, смещение и длина имени, a, b, c;
+    # для каталога a/b - первый ребёнок и число детей, для файла - смещение и длина
+    # хранимого содержимого и его исходный размер
+    NODE = struct.Struct('<BBHIIIQQQ')
+    ROOT = 0
+    ENCODING_RAW = 0
+    ENCODING_ZLIB = 1
+    # Образ собран с --compress: compact пересобирает его так же
+    FLAG_COMPRESSED = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            mmap = lazy_import('mmap')
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.node_count, self.names_offset, self.names_size, self.blobs_offset, _ = \
+            self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path}: не является образом VFS")
+        if version != self.VERSION:
+            raise ValueError(f"{path}: неподдерживаемая версия образа {version}")
+        self.view = memoryview(self.mm)
+        # Дескрипторы сжатого содержимого по смещению, чтобы кэш распаковки их узнавал
+        self._compressed = {}
+
+    @classmethod
+    def is_image(cls, path: str) -> bool:
+        try:
+            with open(path, 'rb') as f:
+                return f.read(len(cls.MAGIC)) == cls.MAGIC
+        except OSError:
+            return False
+
+    @property
+    def compressed(self) -> bool:
+        """Собран ли образ со сжатием; у образов без флага - есть ли сжатые узлы"""
+        if self.flags & self.FLAG_COMPRESSED:
+            return True
+        return any(self._node(index)[1] == self.ENCODING_ZLIB for index in range(self.node_count))
+
+    def _node(self, index: int) -> tuple:
+        return self.NODE.unpack_from(self.mm, self.HEADER.size + index * self.NODE.size)
+
+    def __len__(self) -> int:
+        return self.node_count
+
+    def is_dir(self, index: int) -> bool:
+        return self._node(index)[0] == KIND_DIR
+
+    def parent(self, index: int) -> int:
+        return self._node(index)[3]
+
+    def name(self, index: int) -> str:
+        node = self._node(index)
+        start = self.names_offset + node[4]
+        return self.mm[start:start + node[5]].decode('utf-8')
+
+    def children(self, index: int) -> range:
+        kind, _, _, _, _, _, first, count, _ = self._node(index)
+        if kind != KIND_DIR:
+            return range(0)
+        return range(first, first + count)
+
+    def child_count(self, index: int) -> int:
+        return len(self.children(index))
+
+    def child_names(self, index: int, start: int = 0, stop: int = None):
+        # Дети в образе уже упорядочены по имени упаковщиком
+        return (self.name(child) for child in self.children(index)[start:stop])
+
+    def lookup(self, index: int, name: str) -> Optional[int]:
+        kind, _, _, _, _, _, first, count, _ = self._node(index)
+        if kind != KIND_DIR:
+            return None
+        key = name.encode('utf-8')
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            node = self._node(mid)
+            start = self.names_offset + node[4]
+            current = self.mm[start:start + node[5]]
+            if current == key:
+                return mid
+            if current < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def content(self, index: int) -> Union[memoryview, LazyContent]:
+        """Содержимое файла как срез отображения без копирования; сжатое - как LazyContent"""
+        node = self._node(index)
+        start = self.blobs_offset + node[6]
+        data = self.view[start:start + node[7]]
+        if node[1] != self.ENCODING_ZLIB:
+            return data
+        handle = self._compressed.get(start)
+        if handle is None:
+            handle = self._compressed[start] = LazyContent(data, 'zlib')
+        return handle
+
+    def size(self, index: int) -> int:
+        return self._node(index)[8]
+
+    def memory_usage(self) -> Dict[str, int]:
+        # Узлы и имена не копируются в кучу - это страницы отображённого файла
+        structure = self.HEADER.size + self.node_count * self.NODE.size + self.names_size
+        return {'structure': structure, 'content': 0}
+
+
+class _OverlayNode:
+    """Инод, изменённый или созданный сессией поверх общего образа"""
+    __slots__ = ('kind', 'name', 'parent', 'data')
+
+    def __init__(self, kind: int, name: str, parent: int, data):
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.data = data
+
+
+class OverlayTable:
+    """Копирование при записи поверх неизменяемой таблицы инодов.
+
+    Изменённые каталоги копируются в верхний слой целиком, остальные узлы
+    читаются из общего базового образа. snapshot() замораживает текущий
+    верхний слой и начинает новый, restore() отбрасывает слои выше снимка;
+    обе операции не зависят от размера дерева.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.ROOT = base.ROOT
+        self.layers = [{}]
+        self.next_ino = len(base)
+
+    def _record(self, ino: int) -> Optional[_OverlayNode]:
+        for layer in reversed(self.layers):
+            record = layer.get(ino)
+            if record is not None:
+                return record
+        return None
+
+    def __len__(self) -> int:
+        return self.next_ino
+
+    def is_dir(self, ino: int) -> bool:
+        record = self._record(ino)
+        if record is None:
+            return self.base.is_dir(ino)
+        return record.kind == KIND_DIR
+
+    def name(self, ino: int) -> str:
+        record = self._record(ino)
+        return self.base.name(ino) if record is None else record.name
+
+    def parent(self, ino: int) -> int:
+        record = self._record(ino)
+        return self.base.parent(ino) if record is None else record.parent
+
+    def lookup(self, ino: int, name: str) -> Optional[int]:
+        record = self._record(ino)
+        if record is None:
+            return self.base.lookup(ino, name)
+        return record.data.get(name) if record.kind == KIND_DIR else None
+
+    def children(self, ino: int):
+        record = self._record(ino)
+        if record is None:
+            return self.base.children(ino)
+        return record.data.all_inodes() if record.kind == KIND_DIR else ()
+
+    def child_count(self, ino: int) -> int:
+        record = self._record(ino)
+        if record is None:
+            return self.base.child_count(ino)
+        return len(record.data) if record.kind == KIND_DIR else 0
+
+    def child_names(self, ino: int, start: int = 0, stop: int = None):
+        record = self._record(ino)
+        if record is None:
+            return self.base.child_names(ino, start, stop)
+        if record.kind != KIND_DIR:
+            return iter(())
+        return record.data.slice_names(start, stop)
+
+    def content(self, ino: int):
+        record = self._record(ino)
+        return self.base.content(ino) if record is None else record.data
+
+    def size(self, ino: int) -> int:
+        record = self._record(ino)
+        return self.base.size(ino) if record is None else _content_size(record.data)
+
+    def _writable_dir(self, ino: int) -> DirEntries:
+        """Каталог в верхнем слое; при первой записи копируется его список детей"""
+        top = self.layers[-1]
+        record = top.get(ino)
+        if record is not None:
+            return record.data
+        source = self._record(ino)
+        entries = DirEntries()
+        if source is None:
+            names = self.base.child_names(ino)
+            inodes = self.base.children(ino)
+            kind, name, parent = KIND_DIR, self.base.name(ino), self.base.parent(ino)
+        else:
+            names = source.data.slice_names()
+            inodes = source.data.all_inodes()
+            kind, name, parent = source.kind, source.name, source.parent
+        for child_name, child in zip(names, inodes):
+            entries.add(child_name, child)
+        top[ino] = _OverlayNode(kind, name, parent, entries)
+        return entries
+
+    def _create(self, parent: int, name: str, kind: int, data) -> int:
+        entries = self._writable_dir(parent)
+        ino = self.next_ino
+        self.next_ino += 1
+        self.layers[-1][ino] = _OverlayNode(kind, sys.intern(name), parent, data)
+        entries.insert(name, ino)
+        return ino
+
+    def add_dir(self, parent: int, name: str) -> int:
+        return self._create(parent, name, KIND_DIR, DirEntries())
+
+    def add_file(self, parent: int, name: str, content) -> int:
+        return self._create(parent, name, KIND_FILE, content)
+
+    def remove(self, parent: int, name: str) -> Optional[int]:
+        return self._writable_dir(parent).remove(name)
+
+    def write(self, ino: int, content):
+        top = self.layers[-1]
+        record = top.get(ino)
+        if record is None:
+            top[ino] = _OverlayNode(KIND_FILE, self.name(ino), self.parent(ino), content)
+        else:
+            record.data = content
+
+    def snapshot(self) -> tuple:
+        self.layers.append({})
+        return len(self.layers) - 1, self.next_ino
+
+    def restore(self, token: tuple):
+        depth, next_ino = token
+        del self.layers[depth:]
+        self.layers.append({})
+        self.next_ino = next_ino
+
+    def memory_usage(self) -> Dict[str, int]:
+        usage = dict(self.base.memory_usage())
+        for layer in self.layers:
+            usage['structure'] += sys.getsizeof(layer)
+            for record in layer.values():
+                usage['structure'] += sys.getsizeof(record)
+                if record.kind == KIND_DIR:
+                    usage['structure'] += record.data.memory_usage()
+                else:
+                    usage['content'] += sys.getsizeof(record.data)
+        return usage
+
+    def overlay_nodes(self) -> int:
+        return sum(len(layer) for layer in self.layers)
+
+
+def _content_bytes(content) -> bytes:
+    if isinstance(content, LazyContent):
+        return content.decode()
+    return content_to_bytes(content)
+
+
+def _content_size(content) -> int:
+    if isinstance(content, LazyContent):
+        return content.size()
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return len(content)
+    return len(content_to_bytes(content))
+
+
+def _content_chunks(content):
+    """Поток байтовых блоков содержимого без декодирования целиком"""
+    if isinstance(content, LazyContent):
+        return content.iter_decode(CHUNK_SIZE)
+    if isinstance(content, memoryview):
+        return (content,)
+    return (content_to_bytes(content),)
+
+
+def iter_lines(chunks):
+    """Строки (без перевода строки) из потока байтовых блоков"""
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + bytes(chunk)).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def pack_image(source_path: str, image_path: str, compress: bool = False) -> Dict[str, int]:
+    """Компилирует образ VFS (JSON или бинарный, вместе с журналом) в бинарный формат VfsImage"""
+    return pack_table(VirtualFileSystem(source_path).fs, image_path, compress)
+
+
+def pack_table(fs, image_path: str, compress: bool = False) -> Dict[str, int]:
+    """Записывает таблицу инодов в бинарный формат VfsImage.
+
+    При compress=True содержимое сжимается zlib, если это уменьшает его размер.
+    """
+    store = BlobStore()
+    records = []
+    names = bytearray()
+    name_offsets = {}
+
+    tempfile = lazy_import('tempfile')
+    shutil = lazy_import('shutil')
+    with tempfile.TemporaryFile() as blobs:
+        blobs_size = 0
+        # Обход в ширину: индексы детей каждого каталога идут подряд
+        queue = deque([(fs.ROOT, 0)])
+        next_index = 1
+        while queue:
+            ino, parent = queue.popleft()
+            encoded = fs.name(ino).encode('utf-8')
+            if encoded not in name_offsets:
+                name_offsets[encoded] = len(names)
+                names += encoded
+            name_off = name_offsets[encoded]
+
+            if fs.is_dir(ino):
+                # Порядок имён в строках Python совпадает с порядком байтов UTF-8
+                children = list(fs.children(ino))
+                index = len(records)
+                records.append((KIND_DIR, 0, 0, parent, name_off, len(encoded),
+                                next_index, len(children), 0))
+                for child in children:
+                    queue.append((child, index))
+                next_index += len(children)
+            else:
+                data = _content_bytes(fs.content(ino))
+
+                def write_blob():
+                    nonlocal blobs_size
+                    stored = data
+                    encoding = VfsImage.ENCODING_RAW
+                    if compress:
+                        packed = lazy_import('zlib').compress(data)
+                        if len(packed) < len(data):
+                            stored = packed
+                            encoding = VfsImage.ENCODING_ZLIB
+                    blobs.write(stored)
+                    blobs_size += len(stored)
+                    return encoding, blobs_size - len(stored), len(stored)
+
+                encoding, offset, stored_size = store.intern(BlobStore.digest(data), len(data), write_blob)
+                records.append((KIND_FILE, encoding, 0, parent, name_off, len(encoded),
+                                offset, stored_size, len(data)))
+
+        names_offset = VfsImage.HEADER.size + len(records) * VfsImage.NODE.size
+        blobs_offset = names_offset + len(names)
+        with open(image_path, 'wb') as out:
+            flags = VfsImage.FLAG_COMPRESSED if compress else 0
+            out.write(VfsImage.HEADER.pack(VfsImage.MAGIC, VfsImage.VERSION, flags, len(records),
+                                           names_offset, len(names), blobs_offset, blobs_size))
+            for record in records:
+                out.write(VfsImage.NODE.pack(*record))
+            out.write(names)
+            blobs.seek(0)
+            shutil.copyfileobj(blobs, out)
+
+    return {'nodes': len(records), 'names_bytes': len(names), 'content_bytes': blobs_size,
+            'image_bytes': blobs_offset + blobs_size, **store.get_stats()}
+
+
+def unpack_image(image_path: str, json_path: str) -> int:
+    """Выгружает бинарный образ обратно в JSON-схему"""
+    return dump_json(VfsImage(image_path), json_path)
+
+
+def _json_leaf(content) -> Dict[str, str]:
+    if isinstance(content, LazyContent):
+        if isinstance(content.raw, memoryview):
+            return {'content': base64.b64encode(content.raw).decode('ascii'), 'encoding': 'zlib+base64'}
+        return {'content': content.raw, 'encoding': content.encoding}
+    return {'content': base64.b64encode(content_to_bytes(content)).decode('ascii'), 'encoding': 'base64'}
+
+
+def dump_json(fs, json_path: str) -> int:
+    """Записывает таблицу инодов в JSON-схему VFS потоково; содержимое остаётся закодированным"""
+    written = 0
+    with open(json_path, 'w', encoding='utf-8') as out:
+        out.write('{"/": {')
+        # Стек итераторов по детям открытых каталогов
+        stack = [iter(fs.children(fs.ROOT))]
+        first = [True]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                first.pop()
+                out.write('}')
+                continue
+            if not first[-1]:
+                out.write(', ')
+            first[-1] = False
+            out.write(json.dumps(fs.name(child), ensure_ascii=False) + ': ')
+            written += 1
+            if fs.is_dir(child):
+                out.write('{')
+                stack.append(iter(fs.children(child)))
+                first.append(True)
+            else:
+                out.write(json.dumps(_json_leaf(fs.content(child)), ensure_ascii=False))
+        out.write('}\n')
+    return written
+
+
+# Файлов в одной задаче пула при сборке образа из каталога
+BUILD_BATCH = 128
+
+
+def _encode_host_files(paths: List[str], compress: bool) -> List[str]:
+    """Читает и кодирует пакет файлов в рабочем процессе; возвращает готовые JSON-листья"""
+    leaves = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if compress:
+            packed = lazy_import('zlib').compress(data)
+            if len(packed) < len(data):
+                leaves.append(json.dumps({'content': base64.b64encode(packed).decode('ascii'),
+                                          'encoding': 'zlib+base64'}))
+                continue
+        leaves.append(json.dumps({'content': base64.b64encode(data).decode('ascii'), 'encoding': 'base64'}))
+    return leaves
+
+
+def _walk_host_tree(root: str):
+    """События обхода каталога: ('dir', имя), ('file', имя, путь), ('end',) - без рекурсии.
+
+    Символические ссылки на каталоги не раскрываются, чтобы не зациклиться.
+    """
+    def listing(path):
+        with os.scandir(path) as entries:
+            return iter(sorted(entries, key=lambda entry: entry.name))
+
+    stack = [listing(root)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            yield ('end',)
+        elif entry.is_dir(follow_symlinks=False):
+            yield ('dir', entry.name)
+            stack.append(listing(entry.path))
+        elif entry.is_file():
+            yield ('file', entry.name, entry.path)
+
+
+def build_vfs(source_dir: str, json_path: str, compress: bool = False, jobs: int = None) -> Dict[str, int]:
+    """Собирает JSON-образ VFS из каталога хост-системы.
+
+    Обход и запись идут в основном процессе потоково, чтение и кодирование
+    файлов - пакетами в пуле процессов. Число пакетов в работе ограничено,
+    поэтому в памяти держится лишь окно закодированных файлов.
+    """
+    if not os.path.isdir(source_dir):
+        raise ValueError(f"{source_dir}: не является каталогом")
+    jobs = jobs or os.cpu_count() or 1
+    window = jobs * 4
+    stats = {'dirs': 0, 'files': 0, 'json_bytes': 0, 'jobs': jobs}
+    pending = deque()
+    batches = deque()
+    batch = []
+    leaves = deque()
+    first = [True]
+    tmp_path = f"{json_path}.tmp"
+    futures = lazy_import('concurrent.futures')
+    pool = futures.ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+    def submit():
+        if pool is not None:
+            batches.append(pool.submit(_encode_host_files, list(batch), compress))
+        else:
+            done = futures.Future()
+            done.set_result(_encode_host_files(batch, compress))
+            batches.append(done)
+        batch.clear()
+
+    def write(out, limit: int):
+        # Пишем готовые события по порядку; ждём пакет, только если в работе их больше limit
+        while pending:
+            event = pending[0]
+            if event[0] == 'file' and not leaves:
+                if len(batches) <= limit:
+                    return
+                leaves.extend(batches.popleft().result())
+            pending.popleft()
+            if event[0] == 'end':
+                out.write('}')
+                first.pop()
+                continue
+            if not first[-1]:
+                out.write(', ')
+            first[-1] = False
+            out.write(json.dumps(event[1], ensure_ascii=False) + ': ')
+            if event[0] == 'dir':
+                out.write('{')
+                first.append(True)
+            else:
+                out.write(leaves.popleft())
+
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            out.write('{"/": {')
+            for event in _walk_host_tree(source_dir):
+                pending.append(event)
+                if event[0] == 'dir':
+                    stats['dirs'] += 1
+                elif event[0] == 'file':
+                    stats['files'] += 1
+                    batch.append(event[2])
+                    if len(batch) >= BUILD_BATCH:
+                        submit()
+                        write(out, window)
+            if batch:
+                submit()
+            write(out, 0)
+            out.write('}\n')
+        stats['json_bytes'] = os.path.getsize(tmp_path)
+        os.replace(tmp_path, json_path)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return stats
+
+
+def _walk(fs, path: str) -> Optional[int]:
+    current = fs.ROOT
+    for part in path.split('/'):
+        if part:
+            current = fs.lookup(current, part)
+            if current is None:
+                return None
+    return current
+
+
+def apply_mutation(fs, record: Dict, resolve=None) -> int:
+    """Применяет запись журнала к OverlayTable; возвращает инод затронутого узла.
+
+    Записи: {"op": "mkdir", "path"}, {"op": "write", "path", "data" (base64), "append"},
+    {"op": "rm", "path"}. Пути абсолютные и нормализованные.
+    """
+    if resolve is None:
+        resolve = lambda target: _walk(fs, target)
+    op = record.get('op')
+    path = record.get('path', '')
+    parent_path, _, name = path.rpartition('/')
+    parent = resolve(parent_path or '/')
+    if not name or parent is None or not fs.is_dir(parent):
+        raise ValueError(f"{path}: нет такого каталога")
+    existing = fs.lookup(parent, name)
+
+    if op == 'mkdir':
+        if existing is not None:
+            raise ValueError(f"{path}: файл существует")
+        return fs.add_dir(parent, name)
+    if op == 'write':
+        data = base64.b64decode(record.get('data', ''))
+        if existing is None:
+            return fs.add_file(parent, name, data)
+        if fs.is_dir(existing):
+            raise ValueError(f"{path}: это каталог")
+        if record.get('append'):
+            if not data:
+                return existing
+            data = _content_bytes(fs.content(existing)) + data
+        fs.write(existing, data)
+        return existing
+    if op == 'rm':
+        if existing is None:
+            raise ValueError(f"{path}: нет такого файла или каталога")
+        fs.remove(parent, name)
+        return existing
+    raise ValueError(f"неизвестная операция журнала: {op}")
+
+
+class Journal:
+    """Журнал изменений рядом с образом (<образ>.journal): по JSON-записи на строку, только дозапись"""
+    SUFFIX = '.journal'
+
+    def __init__(self, image_path: str):
+        self.path = image_path + self.SUFFIX
+        self.records = 0
+        self._file = None
+
+    def append(self, record: Dict):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.records += 1
+
+    def replay(self, fs) -> int:
+        """Применяет записи журнала к таблице; оборванная последняя строка пропускается"""
+        count = 0
+        try:
+            f = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return 0
+        with f:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if not line.endswith('\n'):
+                        break
+                    raise ValueError(f"{self.path}: повреждена запись на строке {line_num}")
+                try:
+                    apply_mutation(fs, record)
+                except ValueError as e:
+                    raise ValueError(f"{self.path}: строка {line_num}: {e}")
+                count += 1
+        return count
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.records = 0
+
+
+class PathResolver:
+    """Разрешение путей в иноды с LRU-кэшем: нормализованный путь -> инод"""
+
+    def __init__(self, fs, capacity: int = 4096):
+        self.fs = fs
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def normalize(path: str, cwd: str = '/') -> str:
+        if not path.startswith('/'):
+            path = f"{cwd.rstrip('/')}/{path}"
+        parts = []
+        for part in path.split('/'):
+            if not part or part == '.':
+                continue
+            if part == '..':
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(part)
+        return '/' + '/'.join(parts)
+
+    def resolve(self, path: str) -> Optional[int]:
+        """Инод по нормализованному абсолютному пути или None"""
+        cache = self._cache
+        ino = cache.get(path)
+        if ino is not None:
+            cache.move_to_end(path)
+            self.hits += 1
+            return ino
+        self.misses += 1
+        if path == '/':
+            return self._remember(path, self.fs.ROOT)
+
+        # Продолжаем обход от самого длинного закэшированного префикса
+        parts = path[1:].split('/')
+        depth = len(parts)
+        current = None
+        while depth > 0:
+            current = cache.get('/' + '/'.join(parts[:depth]))
+            if current is not None:
+                break
+            depth -= 1
+        if current is None:
+            current = self.fs.ROOT
+
+        for i in range(depth, len(parts)):
+            current = self.fs.lookup(current, parts[i])
+            if current is None:
+                return None
+            self._remember('/' + '/'.join(parts[:i + 1]), current)
+        return current
+
+    def _remember(self, path: str, ino: int) -> int:
+        self._cache[path] = ino
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+        return ino
+
+    def invalidate(self, path: str = None):
+        """Сбрасывает запись для пути и всех путей под ним; без аргумента - весь кэш"""
+        if path is None or path == '/':
+            self._cache.clear()
+            return
+        prefix = path + '/'
+        for key in [key for key in self._cache if key == path or key.startswith(prefix)]:
+            del self._cache[key]
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class NameIndex:
+    """Индекс имён: имя -> иноды с этим именем, плюс отсортированный список различных имён.
+
+    Точное имя ищется за O(1), шаблон с буквальным префиксом - бинарным поиском
+    по диапазону имён; полный обход дерева не нужен.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self._sorted = None
+
+    @classmethod
+    def build(cls, fs) -> 'NameIndex':
+        index = cls()
+        stack = [fs.ROOT]
+        while stack:
+            ino = stack.pop()
+            for child in fs.children(ino):
+                index.add(fs.name(child), child)
+                if fs.is_dir(child):
+                    stack.append(child)
+        return index
+
+    def add(self, name: str, ino: int):
+        inodes = self.postings.get(name)
+        if inodes is None:
+            self.postings[name] = inodes = array('I')
+            self._sorted = None
+        inodes.append(ino)
+
+    def __len__(self) -> int:
+        return len(self.postings)
+
+    def match(self, pattern: str):
+        """Пары (имя, иноды) для имён, подходящих под glob-шаблон"""
+        wildcard = min((i for i in (pattern.find(c) for c in '*?[') if i >= 0), default=-1)
+        if wildcard < 0:
+            inodes = self.postings.get(pattern)
+            if inodes is not None:
+                yield pattern, inodes
+            return
+        if self._sorted is None:
+            self._sorted = sorted(self.postings)
+        names = self._sorted
+        prefix = pattern[:wildcard]
+        start = bisect_left(names, prefix)
+        for i in range(start, len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if lazy_import('fnmatch').fnmatchcase(name, pattern):
+                yield name, self.postings[name]
+
+
+WORD_RE = re.compile(rb'\w+')
+# Шаблоны без этих символов ищутся как литералы и могут идти через индекс слов
+REGEX_META_RE = re.compile(r'[.^$*+?()\[\]{}|\\]')
+
+
+class ContentIndex:
+    """Инвертированный индекс по содержимому файлов: слово -> иноды файлов, где оно встречается.
+
+    Для литерала возвращает множество файлов-кандидатов, которые затем проверяются
+    обычным сканированием; остальные файлы читать не нужно.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self._vocabulary = None
+
+    @classmethod
+    def build(cls, fs) -> 'ContentIndex':
+        index = cls()
+        stack = [fs.ROOT]
+        while stack:
+            ino = stack.pop()
+            for child in fs.children(ino):
+                if fs.is_dir(child):
+                    stack.append(child)
+                else:
+                    index.add_file(child, _content_chunks(fs.content(child)))
+        return index
+
+    def add_file(self, ino: int, chunks):
+        words = set()
+        # Слово на границе блоков может продолжиться в следующем: его части копятся
+        # списком, чтобы длинные слова (base64, hex) не копировались заново с каждым блоком
+        parts = []
+        for chunk in chunks:
+            data = bytes(chunk)
+            if not data:
+                continue
+            found = WORD_RE.findall(data)
+            ends_open = WORD_RE.match(data, len(data) - 1) is not None
+            if parts and WORD_RE.match(data) is not None:
+                head = found.pop(0)
+                if ends_open and not found:
+                    parts.append(head)
+                    continue
+                words.add(b''.join(parts) + head)
+                parts = []
+            elif parts:
+                words.add(b''.join(parts))
+                parts = []
+            if ends_open:
+                parts.append(found.pop())
+            words.update(found)
+        if parts:
+            words.add(b''.join(parts))
+        for word in words:
+            inodes = self.postings.get(word)
+            if inodes is None:
+                self.postings[word] = inodes = array('I')
+            inodes.append(ino)
+        self._vocabulary = None
+
+    def __len__(self) -> int:
+        return len(self.postings)
+
+    def _words_containing(self, token: bytes):
+        """Слова словаря, содержащие token; поиск по склеенному словарю идёт на уровне C"""
+        if self._vocabulary is None:
+            words = sorted(self.postings)
+            offsets = array('Q')
+            position = 0
+            for word in words:
+                offsets.append(position)
+                position += len(word) + 1
+            self._vocabulary = (b'\n'.join(words), offsets, words)
+        blob, offsets, words = self._vocabulary
+        position = blob.find(token)
+        while position >= 0:
+            i = bisect_right(offsets, position) - 1
+            yield words[i]
+            if i + 1 >= len(offsets):
+                break
+            position = blob.find(token, offsets[i + 1])
+
+    def candidates(self, literal: bytes) -> Optional[set]:
+        """Иноды файлов, которые могут содержать literal; None, если в литерале нет слов"""
+        tokens = list(WORD_RE.finditer(literal))
+        if not tokens:
+            return None
+        result = None
+        for match in tokens:
+            token = match.group()
+            # Крайние слова литерала могут быть частью более длинного слова в файле
+            left_open = match.start() == 0
+            right_open = match.end() == len(literal)
+            found = set()
+            if not left_open and not right_open:
+                found.update(self.postings.get(token, ()))
+            else:
+                for word in self._words_containing(token):
+                    if (left_open or word.startswith(token)) and (right_open or word.endswith(token)):
+                        found.update(self.postings[word])
+            result = found if result is None else result & found
+            if not result:
+                break
+        return result
+
+
+class SubtreeTotals:
+    """Размер в байтах и число файлов в поддереве каждого каталога, по иноду"""
+
+    def __init__(self, count: int):
+        self.sizes = array('Q', bytes(8 * count))
+        self.files = array('I', bytes(4 * count))
+
+    @classmethod
+    def build(cls, fs) -> 'SubtreeTotals':
+        """Один линейный проход: файлы учитываются в родителе, затем каталоги снизу вверх"""
+        totals = cls(len(fs))
+        sizes, files = totals.sizes, totals.files
+        order = array('I')
+        stack = [fs.ROOT]
+        while stack:
+            ino = stack.pop()
+            order.append(ino)
+            for child in fs.children(ino):
+                if fs.is_dir(child):
+                    stack.append(child)
+                else:
+                    sizes[ino] += fs.size(child)
+                    files[ino] += 1
+        for ino in reversed(order):
+            if ino != fs.ROOT:
+                parent = fs.parent(ino)
+                sizes[parent] += sizes[ino]
+                files[parent] += files[ino]
+        return totals
+
+    def get(self, ino: int) -> tuple:
+        if ino >= len(self.sizes):
+            return 0, 0
+        return self.sizes[ino], self.files[ino]
+
+
+class BaseImage:
+    """Загруженный неизменяемый образ VFS, общий для всех сессий процесса"""
+
+    def __init__(self, fs, load_stats: Dict[str, object], blobs: BlobStore = None):
+        self.fs = fs
+        self.load_stats = load_stats
+        self.blobs = blobs if blobs is not None else BlobStore()
+        self.content_cache = DecodeCache()
+        self._name_index = None
+        self._content_index = None
+        self._subtree_totals = None
+
+    def name_index(self) -> NameIndex:
+        """Индекс имён базового дерева; строится один раз при первом поиске и общий для сессий"""
+        if self._name_index is None:
+            started = time.perf_counter()
+            self._name_index = NameIndex.build(self.fs)
+            self.load_stats['name_index_seconds'] = round(time.perf_counter() - started, 4)
+        return self._name_index
+
+    def content_index(self) -> ContentIndex:
+        """Индекс слов по содержимому базового дерева; строится при первом grep -r по литералу"""
+        if self._content_index is None:
+            started = time.perf_counter()
+            self._content_index = ContentIndex.build(self.fs)
+            self.load_stats['content_index_seconds'] = round(time.perf_counter() - started, 4)
+            self.load_stats['content_index_words'] = len(self._content_index)
+        return self._content_index
+
+    def subtree_totals(self) -> SubtreeTotals:
+        """Агрегаты каталогов базового дерева; считаются один раз и общие для сессий"""
+        if self._subtree_totals is None:
+            started = time.perf_counter()
+            self._subtree_totals = SubtreeTotals.build(self.fs)
+            self.load_stats['subtree_totals_seconds'] = round(time.perf_counter() - started, 4)
+        return self._subtree_totals
+
+
+# Загруженные образы и образы с применённым журналом: путь -> (ключ состояния файлов, образ)
+_base_images: Dict[str, tuple] = {}
+_journaled_images: Dict[str, tuple] = {}
+
+
+def make_leaf(value: Dict):
+    if value['encoding'] in LAZY_ENCODINGS:
+        return LazyContent(value['content'], value['encoding'])
+    return content_to_bytes(value['content'])
+
+
+def _load_json_image(vfs_path: str) -> BaseImage:
+    loader = StreamingJsonLoader(make_leaf)
+    started = time.perf_counter()
+    with open(vfs_path, 'rb') as f:
+        try:
+            fs = loader.load(f)
+        except ValueError as e:
+            raise ValueError(f"{vfs_path}: {e}")
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    return BaseImage(fs, {
+        **loader.blobs.get_stats(),
+        'load_bytes': loader.bytes_read,
+        'load_seconds': round(elapsed, 4),
+        'load_mb_per_s': round(loader.bytes_read / elapsed / (1024 * 1024), 2),
+        'load_nodes_per_s': round(len(fs) / elapsed),
+        'lazy_files': loader.lazy_files,
+        'compressed_files': loader.compressed_files,
+        'compressed_bytes': loader.compressed_bytes,
+    }, loader.blobs)
+
+
+def _stat_key(path: str) -> tuple:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def open_base_image(vfs_path: str) -> BaseImage:
+    """Образ по пути; повторные открытия того же неизменённого файла разделяют одну копию.
+
+    Если рядом есть журнал, поверх образа применяются его записи.
+    """
+    path = os.path.abspath(vfs_path)
+    key = _stat_key(path)
+    cached = _base_images.get(path)
+    if cached is not None and cached[0] == key:
+        image = cached[1]
+    else:
+        if VfsImage.is_image(path):
+            started = time.perf_counter()
+            fs = VfsImage(path)
+            image = BaseImage(fs, {'load_seconds': round(time.perf_counter() - started, 4)})
+        else:
+            image = _load_json_image(vfs_path)
+        _base_images[path] = (key, image)
+
+    journal = Journal(path)
+    try:
+        journal_key = key + _stat_key(journal.path)
+    except FileNotFoundError:
+        return image
+    cached = _journaled_images.get(path)
+    if cached is not None and cached[0] == journal_key:
+        return cached[1]
+    started = time.perf_counter()
+    fs = OverlayTable(image.fs)
+    records = journal.replay(fs)
+    journaled = BaseImage(fs, {
+        **image.load_stats,
+        'journal_records': records,
+        'journal_replay_seconds': round(time.perf_counter() - started, 4),
+    }, image.blobs)
+    journaled.content_cache = image.content_cache
+    _journaled_images[path] = (journal_key, journaled)
+    return journaled
+
+
+def forget_base_image(vfs_path: str):
+    path = os.path.abspath(vfs_path)
+    _base_images.pop(path, None)
+    _journaled_images.pop(path, None)
+
+
+# Сколько секунд доверять закэшированным stat и спискам каталогов хост-системы
+HOST_CACHE_TTL = 2.0
+
+
+class HostContent(LazyContent):
+    """Файл хост-системы: читается с диска только при обращении, крупный - потоково"""
+    __slots__ = ('length',)
+
+    def __init__(self, path: str, length: int):
+        super().__init__(path, 'host')
+        self.length = length
+
+    def decode(self) -> bytes:
+        try:
+            with open(self.raw, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            raise ValueError(f"{self.raw}: {e.strerror}")
+
+    def iter_decode(self, chunk_size: int = CHUNK_SIZE):
+        try:
+            with open(self.raw, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        except OSError as e:
+            raise ValueError(f"{self.raw}: {e.strerror}")
+
+    def stored_size(self) -> int:
+        return self.length
+
+    def size(self) -> int:
+        return self.length
+
+
+class HostTable:
+    """Каталог хост-системы как таблица инодов только для чтения.
+
+    Иноды выдаются путям при первом обращении. Результаты stat и списки
+    каталогов живут в кэше HOST_CACHE_TTL секунд, так что повторные ls/cat
+    в скрипте не обращаются к диску.
+
+    Как и в build-vfs, символические ссылки на каталоги не раскрываются - иначе
+    ссылка выводила бы за пределы подключённого каталога или зацикливала обход.
+    Ссылки на файлы видны, только если файл лежит внутри подключённого каталога.
+    """
+    ROOT = 0
+
+    def __init__(self, root_path: str, ttl: float = None):
+        root_path = os.path.abspath(root_path)
+        self.real_root = os.path.realpath(root_path)
+        self.ttl = HOST_CACHE_TTL if ttl is None else ttl
+        self.paths = [root_path]
+        self.names = ['']
+        self.parents = array('I', [0])
+        self.inodes = {root_path: 0}
+        self.hits = 0
+        self.misses = 0
+        self._stats = {}
+        self._listings = {}
+        self._contents = {}
+
+    def _stat(self, path: str) -> Optional[tuple]:
+        """(каталог ли, размер, mtime) или None, если пути нет"""
+        now = time.monotonic()
+        cached = self._stats.get(path)
+        if cached is not None and cached[0] > now:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        stat = lazy_import('stat')
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                st = self._link_target(path)
+        except OSError:
+            st = None
+        info = None if st is None else (stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime_ns)
+        self._stats[path] = (now + self.ttl, info)
+        return info
+
+    def _link_target(self, path: str) -> Optional[os.stat_result]:
+        """stat файла, на который ведёт ссылка, или None: ссылки на каталоги и за пределы корня скрыты"""
+        target = os.path.realpath(path)
+        if os.path.commonpath([target, self.real_root]) != self.real_root:
+            return None
+        st = os.stat(target)
+        return None if lazy_import('stat').S_ISDIR(st.st_mode) else st
+
+    def _inode(self, parent: int, name: str) -> int:
+        path = os.path.join(self.paths[parent], name)
+        ino = self.inodes.get(path)
+        if ino is None:
+            ino = self.inodes[path] = len(self.paths)
+            self.paths.append(path)
+            self.names.append(name)
+            self.parents.append(parent)
+        return ino
+
+    def _listing(self, ino: int) -> tuple:
+        """(отсортированные имена, иноды) содержимого каталога"""
+        path = self.paths[ino]
+        now = time.monotonic()
+        cached = self._listings.get(path)
+        if cached is not None and cached[0] > now:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        try:
+            with os.scandir(path) as entries:
+                names = sorted(entry.name for entry in entries
+                               if not entry.is_symlink() or self._stat(entry.path) is not None)
+        except OSError:
+            names = []
+        listing = (names, [self._inode(ino, name) for name in names])
+        self._listings[path] = (now + self.ttl, listing)
+        return listing
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def is_dir(self, ino: int) -> bool:
+        info = self._stat(self.paths[ino])
+        return info is not None and info[0]
+
+    def name(self, ino: int) -> str:
+        return self.names[ino]
+
+    def parent(self, ino: int) -> int:
+        return self.parents[ino]
+
+    def lookup(self, ino: int, name: str) -> Optional[int]:
+        if not name or name in ('.', '..') or '/' in name or not self.is_dir(ino):
+            return None
+        cached = self._listings.get(self.paths[ino])
+        if cached is not None and cached[0] > time.monotonic():
+            self.hits += 1
+            names, inodes = cached[1]
+            i = bisect_left(names, name)
+            return inodes[i] if i < len(names) and names[i] == name else None
+        if self._stat(os.path.join(self.paths[ino], name)) is None:
+            return None
+        return self._inode(ino, name)
+
+    def children(self, ino: int):
+        if not self.is_dir(ino):
+            return ()
+        return self._listing(ino)[1]
+
+    def child_count(self, ino: int) -> int:
+        return len(self._listing(ino)[0]) if self.is_dir(ino) else 0
+
+    def child_names(self, ino: int, start: int = 0, stop: int = None):
+        if not self.is_dir(ino):
+            return iter(())
+        return iter(self._listing(ino)[0][start:stop])
+
+    def content(self, ino: int) -> HostContent:
+        """Один и тот же объект, пока файл не изменился, - по нему попадает кэш декодирования"""
+        path = self.paths[ino]
+        info = self._stat(path)
+        if info is None:
+            raise ValueError(f"{path}: файл исчез с диска")
+        cached = self._contents.get(path)
+        if cached is not None and cached[0] == info:
+            return cached[1]
+        handle = HostContent(path, info[1])
+        self._contents[path] = (info, handle)
+        return handle
+
+    def size(self, ino: int) -> int:
+        info = self._stat(self.paths[ino])
+        return info[1] if info is not None else 0
+
+    def memory_usage(self) -> Dict[str, int]:
+        structure = (sys.getsizeof(self.paths) + sys.getsizeof(self.inodes) + sys.getsizeof(self.parents)
+                     + sum(sys.getsizeof(path) for path in self.paths))
+        return {'structure': structure, 'content': 0}
+
+
+class LiveTotals:
+    """Агрегаты изменяемого источника: поддерево обходится при каждом запросе"""
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def get(self, ino: int) -> tuple:
+        size = files = 0
+        stack = [ino]
+        while stack:
+            for child in self.fs.children(stack.pop()):
+                if self.fs.is_dir(child):
+                    stack.append(child)
+                else:
+                    size += self.fs.size(child)
+                    files += 1
+        return size, files
+
+
+class HostImage(BaseImage):
+    """Каталог хост-системы в роли подключённого образа.
+
+    Содержимое может меняться в любой момент, поэтому индексы имён и
+    содержимого не строятся (None), а агрегаты считаются обходом.
+    """
+
+    def __init__(self, root_path: str):
+        super().__init__(HostTable(root_path), {'host_root': os.path.abspath(root_path)})
+
+    def name_index(self) -> Optional[NameIndex]:
+        return None
+
+    def content_index(self) -> Optional[ContentIndex]:
+        return None
+
+    def subtree_totals(self) -> LiveTotals:
+        return LiveTotals(self.fs)
+
+
+# Иноды подключённого образа с номером k: (k << MOUNT_SHIFT) | локальный инод
+MOUNT_SHIFT = 32
+MOUNT_MASK = (1 << MOUNT_SHIFT) - 1
+
+
+class _Mount:
+    """Образ, подключённый в каталог; загружается при первом обращении внутрь"""
+    __slots__ = ('index', 'point', 'image_path', 'image')
+
+    def __init__(self, index: int, point: int, image_path: str):
+        self.index = index
+        self.point = point
+        self.image_path = image_path
+        self.image = None
+
+
+class MountTable:
+    """Дерево сессии: оверлей корневого образа и подключённые поверх каталогов образы.
+
+    Иноды корневого дерева используются как есть, иноды подключённых образов
+    кодируются номером подключения в старших битах. Каталог-точка монтирования
+    перекрывается корнем образа; сам образ открывается только когда нужно его
+    содержимое. Подключённые образы доступны только для чтения.
+    """
+
+    def __init__(self, base: BaseImage):
+        self.base = base
+        self.root = OverlayTable(base.fs)
+        self.ROOT = self.root.ROOT
+        self.mounts = [None]
+        self.points = {}
+
+    def mount(self, point: int, image_path: str) -> _Mount:
+        if point in self.points or (point >> MOUNT_SHIFT and not point & MOUNT_MASK):
+            raise ValueError("точка монтирования уже занята")
+        mount = _Mount(len(self.mounts), point, image_path)
+        self.mounts.append(mount)
+        self.points[point] = mount
+        return mount
+
+    def _image(self, index: int) -> BaseImage:
+        if not index:
+            return self.base
+        mount = self.mounts[index]
+        if mount.image is None:
+            if os.path.isdir(mount.image_path):
+                mount.image = HostImage(mount.image_path)
+            else:
+                mount.image = open_base_image(mount.image_path)
+        return mount.image
+
+    def _table(self, ino: int) -> tuple:
+        index = ino >> MOUNT_SHIFT
+        if not index:
+            return self.root, ino
+        return self._image(index).fs, ino & MOUNT_MASK
+
+    def _global(self, index: int, local: int) -> int:
+        ino = index << MOUNT_SHIFT | local
+        mount = self.points.get(ino)
+        return ino if mount is None else mount.index << MOUNT_SHIFT
+
+    def locate(self, ino: int) -> tuple:
+        """(образ, локальный инод); для корневого дерева образ - базовый"""
+        index = ino >> MOUNT_SHIFT
+        return self._image(index), ino & MOUNT_MASK
+
+    def globalize(self, index: int, local: int) -> int:
+        return self._global(index, local)
+
+    def has_inode(self, ino: int) -> bool:
+        index = ino >> MOUNT_SHIFT
+        if not index:
+            return ino < len(self.root)
+        if index >= len(self.mounts):
+            return False
+        if not ino & MOUNT_MASK:
+            return True
+        return (ino & MOUNT_MASK) < len(self._image(index).fs)
+
+    def mounts_within(self, ino: int):
+        """Подключения, точки которых лежат в том же образе под ino"""
+        index = ino >> MOUNT_SHIFT
+        for point, mount in self.points.items():
+            if point >> MOUNT_SHIFT != index:
+                continue
+            table, local = self._table(point)
+            target = ino & MOUNT_MASK
+            while True:
+                if local == target:
+                    yield mount
+                    break
+                if local == table.ROOT:
+                    break
+                local = table.parent(local)
+
+    def __len__(self) -> int:
+        return len(self.root)
+
+    @property
+    def layers(self) -> list:
+        return self.root.layers
+
+    def is_dir(self, ino: int) -> bool:
+        if ino >> MOUNT_SHIFT and not ino & MOUNT_MASK:
+            return True
+        table, local = self._table(ino)
+        return table.is_dir(local)
+
+    def name(self, ino: int) -> str:
+        if ino >> MOUNT_SHIFT and not ino & MOUNT_MASK:
+            return self.name(self.mounts[ino >> MOUNT_SHIFT].point)
+        table, local = self._table(ino)
+        return table.name(local)
+
+    def parent(self, ino: int) -> int:
+        index = ino >> MOUNT_SHIFT
+        if index and not ino & MOUNT_MASK:
+            return self.parent(self.mounts[index].point)
+        table, local = self._table(ino)
+        return self._global(index, table.parent(local))
+
+    def lookup(self, ino: int, name: str) -> Optional[int]:
+        table, local = self._table(ino)
+        found = table.lookup(local, name)
+        return None if found is None else self._global(ino >> MOUNT_SHIFT, found)
+
+    def children(self, ino: int):
+        index = ino >> MOUNT_SHIFT
+        table, local = self._table(ino)
+        inodes = table.children(local)
+        if not index and not self.points:
+            return inodes
+        return [self._global(index, child) for child in inodes]
+
+    def child_count(self, ino: int) -> int:
+        table, local = self._table(ino)
+        return table.child_count(local)
+
+    def child_names(self, ino: int, start: int = 0, stop: int = None):
+        table, local = self._table(ino)
+        return table.child_names(local, start, stop)
+
+    def content(self, ino: int):
+        table, local = self._table(ino)
+        return table.content(local)
+
+    def size(self, ino: int) -> int:
+        table, local = self._table(ino)
+        return table.size(local)
+
+    def memory_usage(self) -> Dict[str, int]:
+        usage = self.root.memory_usage()
+        for mount in self.mounts[1:]:
+            if mount.image is not None:
+                for key, value in mount.image.fs.memory_usage().items():
+                    usage[key] += value
+        return usage
+
+    def _writable(self, ino: int):
+        if ino >> MOUNT_SHIFT:
+            raise ValueError("файловая система только для чтения")
+
+    def add_dir(self, parent: int, name: str) -> int:
+        self._writable(parent)
+        return self.root.add_dir(parent, name)
+
+    def add_file(self, parent: int, name: str, content) -> int:
+        self._writable(parent)
+        return self.root.add_file(parent, name, content)
+
+    def remove(self, parent: int, name: str) -> Optional[int]:
+        self._writable(parent)
+        if self.busy(self.root.lookup(parent, name)):
+            raise ValueError("устройство или ресурс занято")
+        return self.root.remove(parent, name)
+
+    def busy(self, ino: int) -> bool:
+        """Есть ли точка подключения в поддереве ino основного дерева"""
+        for point in self.points:
+            current = point
+            while current >> MOUNT_SHIFT == 0:
+                if current == ino:
+                    return True
+                if current == self.ROOT:
+                    break
+                current = self.root.parent(current)
+        return False
+
+    def write(self, ino: int, content):
+        self._writable(ino)
+        self.root.write(ino, content)
+
+    def snapshot(self) -> tuple:
+        return self.root.snapshot()
+
+    def restore(self, token: tuple):
+        self.root.restore(token)
+
+    def overlay_nodes(self) -> int:
+        return self.root.overlay_nodes()
+
+
+def load_manifest(manifest_path: str) -> tuple:
+    """Манифест подключений: {"root": образ или null, "mounts": {"/путь": образ}}.
+
+    Относительные пути образов считаются от каталога манифеста.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('mounts', {}), dict):
+        raise ValueError(f"{manifest_path}: ожидается объект с полем mounts")
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    root = manifest.get('root')
+    if root:
+        root = os.path.join(folder, root)
+    mounts = {point: os.path.join(folder, image) for point, image in manifest.get('mounts', {}).items()}
+    return root, mounts
 
 
 class VirtualFileSystem:
 
-    def __init__(self, vfs_path: str = None):
-        self.root = {}
+    def __init__(self, vfs_path: str = None, mounts: Dict[str, str] = None, base: 'BaseImage' = None):
         self.current_path = '/'
         self.vfs_path = vfs_path
-        if vfs_path:
-            self._load_from_json(vfs_path)
+        if base is not None:
+            # Образ, закреплённый сервером: сеансы не перечитывают его при изменении файла
+            self.base = base
+        elif vfs_path:
+            self.base = open_base_image(vfs_path)
         else:
-            self._init_default_structure()
+            self.base = BaseImage(self._init_default_structure(), {})
+        self.fs = MountTable(self.base)
+        self.journal = Journal(vfs_path) if vfs_path else None
+        # Имена узлов, созданных в этой сессии, поверх общего индекса базового образа
+        self.added_names = NameIndex()
+        # Файлы, записанные в этой сессии: индекс базового образа для них неактуален
+        self.written_files = set()
+        # Изменения агрегатов каталогов в этой сессии: инод -> [байты, файлы]
+        self.total_deltas = {}
+        self._identity = None
+        self.content_cache = self.base.content_cache
+        self.resolver = PathResolver(self.fs)
+        self.cwd = self.resolver.resolve(self.current_path)
+        for point, image_path in (mounts or {}).items():
+            self.mount(image_path, point)
 
-    def _load_from_json(self, vfs_path: str):
-        with open(vfs_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        self.root = self._deserialize_node(data)
-        self.current_path = '/'
+    def mount(self, image_path: str, path: str):
+        """Подключает образ или каталог хост-системы в существующий каталог.
 
-    def _deserialize_node(self, node):
-        if not isinstance(node, dict):
-            return node
-        result = {}
-        for key, value in node.items():
-            if isinstance(value, dict) and 'content' in value and 'encoding' in value:
-                if value['encoding'] == 'base64':
-                    content = base64.b64decode(value['content']).decode('utf-8')
-                else:
-                    content = value['content']
-                result[key] = content
-            elif isinstance(value, dict):
-                result[key] = self._deserialize_node(value)
+        Образ читается при первом обращении внутрь точки монтирования.
+        """
+        point = self.resolve(path)
+        if point is None or not self.fs.is_dir(point):
+            raise ValueError(f"{path}: нет такого каталога")
+        if point == self.fs.ROOT:
+            # Корень заменяется образом целиком: это root в манифесте или vfs_path
+            raise ValueError(f"{path}: нельзя подключить в корневой каталог")
+        if not os.path.exists(image_path):
+            raise ValueError(f"{image_path}: файл образа не найден")
+        self.fs.mount(point, os.path.abspath(image_path))
+        self.resolver.invalidate()
+        if self.current_path != '/':
+            self.cwd = self.resolver.resolve(self.current_path)
+
+    def mount_points(self) -> List[tuple]:
+        """(образ, путь, загружен ли) для всех подключений"""
+        return [(mount.image_path, self.path_of(mount.index << MOUNT_SHIFT), mount.image is not None)
+                for mount in self.fs.mounts[1:]]
+
+    def snapshot(self) -> tuple:
+        """Дешёвый снимок состояния сессии: дерево и текущий каталог"""
+        deltas = {ino: list(delta) for ino, delta in self.total_deltas.items()}
+        return self.fs.snapshot(), self.current_path, self.cwd, deltas
+
+    def restore(self, snapshot: tuple):
+        """Откатывает сессию к снимку; записи, уже попавшие в журнал, не отменяются"""
+        token, self.current_path, self.cwd, self.total_deltas = snapshot
+        self.fs.restore(token)
+        self.resolver.invalidate()
+
+    def _mutate(self, record: Dict) -> int:
+        created = len(self.fs)
+        op = record['op']
+        existing = self.resolver.resolve(record['path'])
+        # Занятость проверяется до подсчёта агрегатов: иначе они загрузили бы подключённый образ
+        if op == 'rm' and existing is not None and self.fs.busy(existing):
+            raise ValueError("устройство или ресурс занято")
+        # Агрегаты всего образа здесь не строятся: новый каталог пуст, а для удаляемого
+        # каталога обходится только его поддерево
+        if existing is None or op == 'mkdir':
+            before = (0, 0)
+        elif not self.fs.is_dir(existing):
+            before = (self.fs.size(existing), 1)
+        elif op == 'rm':
+            before = LiveTotals(self.fs).get(existing)
+        else:
+            # Запись поверх каталога всё равно завершится ошибкой
+            before = (0, 0)
+        ino = apply_mutation(self.fs, record, self.resolver.resolve)
+        if ino >= created:
+            self.added_names.add(self.fs.name(ino), ino)
+        if op == 'write':
+            self.written_files.add(ino)
+        after = (0, 0) if op in ('rm', 'mkdir') else self.totals(ino)
+        if after != before:
+            self._propagate_totals(self.fs.parent(ino), after[0] - before[0], after[1] - before[1])
+        if self.journal is not None:
+            self.journal.append(record)
+        return ino
+
+    def _propagate_totals(self, ino: int, size: int, files: int):
+        """Поправка агрегатов всех каталогов от ino до корня"""
+        while True:
+            delta = self.total_deltas.get(ino)
+            if delta is None:
+                self.total_deltas[ino] = [size, files]
             else:
-                result[key] = value
-        return result
+                delta[0] += size
+                delta[1] += files
+            if ino == self.fs.ROOT:
+                return
+            ino = self.fs.parent(ino)
+
+    def _own_totals(self, ino: int) -> tuple:
+        image, local = self.fs.locate(ino)
+        size, files = image.subtree_totals().get(local)
+        delta = self.total_deltas.get(ino)
+        if delta is not None:
+            size += delta[0]
+            files += delta[1]
+        return size, files
 
-    def _init_default_structure(self):
-        self.root['/'] = {}
-        self.root['/']['home'] = {}
-        self.root['/']['home'][self._get_real_username()] = {}
-        self.root['/']['bin'] = {}
-        self.root['/']['bin']['ls'] = "executable"
-        self.root['/']['bin']['cd'] = "executable"
-        self.root['/']['bin']['pwd'] = "executable"
-        self.root['/']['bin']['rev'] = "executable"
-        self.root['/']['bin']['cal'] = "executable"
-        self.root['/']['etc'] = {}
-        self.root['/']['etc']['passwd'] = "root:x:0:0:root:/root:/bin/bash\nuser:x:1000:1000:user:/home/user:/bin/bash"
-        self.root['/']['etc']['hosts'] = "127.0.0.1 localhost\n::1 localhost"
-        self.root['/']['tmp'] = {}
+    def totals(self, ino: int) -> tuple:
+        """(байты, число файлов) в поддереве за O(1): агрегаты образа плюс изменения сессии.
+
+        Подключённые ниже образы заменяют содержимое перекрытых ими каталогов.
+        """
+        if not self.fs.is_dir(ino):
+            return self.fs.size(ino), 1
+        size, files = self._own_totals(ino)
+        for mount in self.fs.mounts_within(ino):
+            mounted = self.totals(mount.index << MOUNT_SHIFT)
+            covered = self._own_totals(mount.point)
+            size += mounted[0] - covered[0]
+            files += mounted[1] - covered[1]
+        return size, files
+
+    def path_of(self, ino: int, name: str = None) -> Optional[str]:
+        """Абсолютный путь инода по ссылкам на родителя или None, если узел отвязан от дерева"""
+        if not self.fs.has_inode(ino):
+            return None
+        parts = []
+        while ino != self.fs.ROOT:
+            current = self.fs.name(ino)
+            if name is not None and not parts and current != name:
+                return None
+            parent = self.fs.parent(ino)
+            if self.fs.lookup(parent, current) != ino:
+                return None
+            parts.append(current)
+            ino = parent
+        return '/' + '/'.join(reversed(parts))
+
+    def _walk_tree(self, start: int, start_path: str):
+        """Пары (путь, инод) для start и всех узлов под ним, без рекурсии"""
+        yield start_path, start
+        stack = [(start, start_path.rstrip('/'))]
+        while stack:
+            ino, base = stack.pop()
+            for child_name, child in zip(self.fs.child_names(ino), self.fs.children(ino)):
+                child_path = f"{base}/{child_name}"
+                yield child_path, child
+                if self.fs.is_dir(child):
+                    stack.append((child, child_path))
+
+    def _indexed_images(self, start_path: str):
+        """(номер подключения, образ) для корневого образа и подключений, пересекающих start_path"""
+        yield 0, self.base
+        prefix = start_path.rstrip('/') + '/'
+        for mount in self.fs.mounts[1:]:
+            mounted = self.path_of(mount.index << MOUNT_SHIFT)
+            if mounted is not None and (mounted.startswith(prefix) or (start_path + '/').startswith(mounted + '/')):
+                yield mount.index, self.fs.locate(mount.index << MOUNT_SHIFT)[0]
+
+    def _grep_files(self, pattern: str, start: int, start_path: str) -> List[tuple]:
+        """Файлы под start, которые нужно просканировать; для литералов - только кандидаты из индекса"""
+        candidates = None
+        if not REGEX_META_RE.search(pattern):
+            literal = pattern.encode('utf-8')
+            for index, image in self._indexed_images(start_path):
+                content_index = image.content_index()
+                found = None if content_index is None else content_index.candidates(literal)
+                if found is None:
+                    candidates = None
+                    break
+                found = {self.fs.globalize(index, ino) for ino in found}
+                candidates = found if candidates is None else candidates | found
+        if candidates is None:
+            return sorted((found, ino) for found, ino in self._walk_tree(start, start_path)
+                          if not self.fs.is_dir(ino))
+
+        prefix = start_path.rstrip('/') + '/'
+        files = []
+        for ino in (candidates - self.written_files) | self.written_files:
+            if not self.fs.has_inode(ino) or self.fs.is_dir(ino):
+                continue
+            found = self.path_of(ino)
+            if found is not None and found.startswith(prefix):
+                files.append((found, ino))
+        return sorted(files)
+
+    def grep(self, pattern: str, path: str, recursive: bool = False):
+        """Тройки (путь, номер строки, строка) для строк файлов под path, где найден pattern"""
+        try:
+            regex = re.compile(pattern.encode('utf-8'))
+        except re.error as e:
+            raise ValueError(f"неверное регулярное выражение: {e}")
+        start = self.resolve(path)
+        if start is None:
+            raise ValueError(f"{path}: Нет такого файла или каталога")
+        start_path = self.normalize_path(path)
+        if not self.is_dir(start):
+            files = [(start_path, start)]
+        elif recursive:
+            files = self._grep_files(pattern, start, start_path)
+        else:
+            raise ValueError(f"{path}: Это каталог")
+        for found, ino in files:
+            for number, line in enumerate(iter_lines(self.iter_file_chunks(ino)), 1):
+                if regex.search(line):
+                    yield found, number, line
+
+    def find(self, path: str, name: str = None, kind: str = None) -> List[str]:
+        """Абсолютные пути под path, подходящие под glob-шаблон имени и тип ('f' или 'd')"""
+        start = self.resolve(path)
+        if start is None:
+            raise ValueError(f"'{path}': нет такого файла или каталога")
+        start_path = self.normalize_path(path)
+        prefix = start_path.rstrip('/') + '/'
+
+        def wanted(ino: int) -> bool:
+            return kind is None or self.fs.is_dir(ino) == (kind == 'd')
+
+        results = []
+        indexes = [(number, image.name_index()) for number, image in self._indexed_images(start_path)]
+        # Без индекса (например, каталог хост-системы в поддереве) - обычный обход
+        if name is None or any(index is None for _, index in indexes):
+            return sorted(found for found, ino in self._walk_tree(start, start_path)
+                          if wanted(ino) and (name is None or lazy_import('fnmatch').fnmatchcase(found.rpartition('/')[2], name)))
+
+        seen = set()
+        indexes.append((0, self.added_names))
+        for number, index in indexes:
+            for matched, inodes in index.match(name):
+                for ino in inodes:
+                    ino = self.fs.globalize(number, ino)
+                    if ino in seen or not self.fs.has_inode(ino) or not wanted(ino):
+                        continue
+                    found = self.path_of(ino, matched)
+                    if found is not None and (found == start_path or found.startswith(prefix)):
+                        seen.add(ino)
+                        results.append(found)
+        return sorted(results)
+
+    def make_dir(self, path: str, parents: bool = False):
+        target = self.normalize_path(path)
+        if not parents:
+            self._mutate({'op': 'mkdir', 'path': target})
+            return
+        prefix = ''
+        for part in target.split('/')[1:]:
+            prefix += '/' + part
+            current = self.resolver.resolve(prefix)
+            if current is None:
+                self._mutate({'op': 'mkdir', 'path': prefix})
+            elif not self.fs.is_dir(current):
+                raise ValueError(f"{prefix}: не является каталогом")
+
+    def touch(self, path: str):
+        self._mutate({'op': 'write', 'path': self.normalize_path(path), 'data': '', 'append': True})
+
+    def write_file(self, path: str, data: bytes, append: bool = False):
+        self._mutate({'op': 'write', 'path': self.normalize_path(path),
+                      'data': base64.b64encode(data).decode('ascii'), 'append': append})
+
+    def remove(self, path: str, recursive: bool = False):
+        target = self.normalize_path(path)
+        if target == '/':
+            raise ValueError("невозможно удалить корневой каталог")
+        current = self.resolver.resolve(target)
+        if current is None:
+            raise ValueError(f"{path}: нет такого файла или каталога")
+        if self.fs.is_dir(current) and not recursive:
+            raise ValueError(f"{path}: это каталог")
+        if self.current_path == target or self.current_path.startswith(target + '/'):
+            raise ValueError(f"{path}: невозможно удалить текущий каталог")
+        self._mutate({'op': 'rm', 'path': target})
+        self.resolver.invalidate(target)
+
+    def compact(self) -> Dict[str, object]:
+        """Сворачивает журнал в новый образ того же формата и удаляет журнал"""
+        if not self.vfs_path:
+            raise ValueError("VFS не загружена из файла")
+        if self.journal is None:
+            raise ValueError("изменения этого сеанса не сохраняются")
+        path = os.path.abspath(self.vfs_path)
+        records = self.base.load_stats.get('journal_records', 0) + self.journal.records
+        persisted = open_base_image(path).fs
+        tmp_path = f"{path}.compact.tmp"
+        try:
+            if VfsImage.is_image(path):
+                nodes = pack_table(persisted, tmp_path, VfsImage(path).compressed)['nodes']
+            else:
+                nodes = dump_json(persisted, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.journal.discard()
+        forget_base_image(path)
+        return {'records': records, 'nodes': nodes, 'image_bytes': os.path.getsize(path)}
+
+    def read_file(self, ino: int) -> Union[bytes, memoryview]:
+        content = self.fs.content(ino)
+        if isinstance(content, LazyContent):
+            return self.content_cache.get(content)
+        if isinstance(content, memoryview):
+            return content
+        return content_to_bytes(content)
+
+    def iter_file_chunks(self, ino: int, chunk_size: int = CHUNK_SIZE):
+        """Содержимое файла блоками фиксированного размера.
+
+        Файлы крупнее кэша декодируются потоково и в кэш не попадают.
+        """
+        content = self.fs.content(ino)
+        if isinstance(content, LazyContent):
+            cached = self.content_cache.peek(content)
+            # Сжатое содержимое обычно в разы больше хранимого, поэтому порог для него ниже
+            limit = self.content_cache.max_bytes
+            if content.encoding in COMPRESSED_ENCODINGS:
+                limit //= 8
+            if cached is None and content.stored_size() > limit:
+                yield from content.iter_decode(chunk_size)
+                return
+            data = cached if cached is not None else self.content_cache.get(content)
+        else:
+            data = self.read_file(ino)
+        view = memoryview(data)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+    def _host_mounts(self) -> list:
+        return [mount for mount in self.fs.mounts[1:] if isinstance(mount.image, HostImage)]
+
+    def get_stats(self) -> Dict[str, object]:
+        cache = self.content_cache
+        nodes = len(self.fs)
+        memory = self.fs.memory_usage()
+        return {
+            **self.base.load_stats,
+            'nodes': nodes,
+            'overlay_nodes': self.fs.overlay_nodes(),
+            'overlay_layers': len(self.fs.layers),
+            'mounts': len(self.fs.mounts) - 1,
+            'mounts_loaded': sum(1 for mount in self.fs.mounts[1:] if mount.image is not None),
+            'host_cache_hits': sum(mount.image.fs.hits for mount in self._host_mounts()),
+            'host_cache_misses': sum(mount.image.fs.misses for mount in self._host_mounts()),
+            'mem_structure_bytes': memory['structure'],
+            'mem_content_bytes': memory['content'],
+            'mem_bytes_per_node': round(memory['structure'] / nodes, 1),
+            **cache.get_stats(),
+            'dentry_entries': len(self.resolver),
+            'dentry_hits': self.resolver.hits,
+            'dentry_misses': self.resolver.misses,
+        }
+
+    def _init_default_structure(self) -> InodeTable:
+        fs = InodeTable()
+        home = fs.add_dir(fs.ROOT, 'home')
+        fs.add_dir(home, self._get_real_username())
+        bin_dir = fs.add_dir(fs.ROOT, 'bin')
+        for name in ('ls', 'cd', 'pwd', 'cat', 'rev', 'cal', 'vfsstat', 'touch', 'mkdir', 'rm', 'echo', 'find', 'grep', 'du', 'tree', 'mount'):
+            fs.add_file(bin_dir, name, b"executable")
+        etc = fs.add_dir(fs.ROOT, 'etc')
+        fs.add_file(etc, 'passwd', b"root:x:0:0:root:/root:/bin/bash\nuser:x:1000:1000:user:/home/user:/bin/bash")
+        fs.add_file(etc, 'hosts', b"127.0.0.1 localhost\n::1 localhost")
+        fs.add_dir(fs.ROOT, 'tmp')
         self.current_path = f"/home/{self._get_real_username()}"
+        return fs
 
     def _get_real_username(self) -> str:
         username = os.getenv('USER')
@@ -67,88 +2519,390 @@ class VirtualFileSystem:
             username = 'user'
         return username
 
-    def get_current_dir(self) -> Dict:
-        path_parts = [p for p in self.current_path.split('/') if p]
-        current = self.root['/']
-        for part in path_parts:
-            if part not in current:
-                return {}
-            current = current[part]
-        return current
+    def normalize_path(self, path: str) -> str:
+        return PathResolver.normalize(path, self.current_path)
+
+    def resolve(self, path: str) -> Optional[int]:
+        """Инод по абсолютному или относительному текущего каталога пути или None"""
+        return self.resolver.resolve(self.normalize_path(path))
+
+    def is_dir(self, ino: int) -> bool:
+        return self.fs.is_dir(ino)
+
+    def list_names(self, ino: int) -> List[str]:
+        return list(self.fs.child_names(ino))
+
+    def iter_names(self, ino: int, offset: int = 0, limit: int = None):
+        """Имена детей каталога по порядку, со сдвигом и ограничением для постраничного вывода"""
+        stop = None if limit is None else offset + limit
+        return self.fs.child_names(ino, offset, stop)
+
+    def get_current_dir(self) -> Optional[int]:
+        return self.cwd
+
+    def change_directory(self, path: str) -> bool:
+        if path == '~':
+            path = f"/home/{self._get_real_username()}"
+
+        target = self.normalize_path(path)
+        current = self.resolver.resolve(target)
+        if current is None or not self.fs.is_dir(current):
+            return False
+
+        self.current_path = target
+        self.cwd = current
+        return True
+
+    def list_directory(self) -> List[str]:
+        current_dir = self.get_current_dir()
+        if current_dir is None or not self.fs.is_dir(current_dir):
+            return []
+        return self.list_names(current_dir)
+
+    def get_prompt(self) -> str:
+        # Имя пользователя и хоста читаются из окружения один раз за сессию
+        if self._identity is None:
+            self._identity = (self._get_real_username(), os.getenv('HOSTNAME', 'localhost'))
+        username, hostname = self._identity
+        display_path = self.current_path
+        home_path = f"/home/{username}"
+        if self.current_path == home_path:
+            display_path = '~'
+        elif self.current_path.startswith(home_path + '/'):
+            display_path = '~' + self.current_path[len(home_path):]
+
+        return f"{username}@{hostname}:{display_path}$ "
+
+
+FLUSH_POLICIES = ('always', 'command', 'full')
+
+
+class OutputSink:
+    """Приёмник вывода команд: текст копится в буфере и сбрасывается в поток по политике.
+
+    always - после каждой записи, command - после каждой команды, full - только при
+    переполнении буфера и в конце работы. По умолчанию для терминала command, иначе full.
+    """
+
+    def __init__(self, stream=None, buffer_size: int = 256 * 1024, flush_policy: str = None):
+        self.stream = stream if stream is not None else sys.stdout
+        if flush_policy is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            flush_policy = 'command' if isatty is not None and isatty() else 'full'
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError(f"неизвестная политика сброса вывода: {flush_policy}")
+        self.flush_policy = flush_policy
+        self.buffer_size = buffer_size
+        self.flushes = 0
+        self._parts = []
+        self._size = 0
+
+    def write(self, text: str):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size or self.flush_policy == 'always':
+            self.flush()
+
+    def print(self, *values, end: str = '\n'):
+        self.write(' '.join(map(str, values)) + end)
+
+    def write_chunks(self, chunks, terminate_empty: bool = True):
+        """Поток байтовых блоков; завершается переводом строки, если его нет в конце.
+
+        terminate_empty=False - пустой поток ничего не выводит (конвейер без результата).
+        """
+        self.flush()
+        buffer = getattr(self.stream, 'buffer', None)
+        last = b''
+        if buffer is None:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            for chunk in chunks:
+                self.stream.write(decoder.decode(chunk))
+                if chunk:
+                    last = chunk
+            self.stream.write(decoder.decode(b'', final=True))
+            if last[-1:] != b'\n' and (last or terminate_empty):
+                self.stream.write('\n')
+        else:
+            for chunk in chunks:
+                buffer.write(chunk)
+                if chunk:
+                    last = chunk
+            if last[-1:] != b'\n' and (last or terminate_empty):
+                buffer.write(b'\n')
+        if self.flush_policy == 'always':
+            self.flush()
+
+    def command_done(self):
+        if self.flush_policy != 'full':
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts.clear()
+            self._size = 0
+        self.stream.flush()
+        self.flushes += 1
+
+
+class CaptureSink(OutputSink):
+    """Вывод в память - для тестов и пакетного запуска"""
+
+    def __init__(self):
+        super().__init__(lazy_import('io').StringIO(), flush_policy='full')
+
+    def getvalue(self) -> str:
+        self.flush()
+        return self.stream.getvalue()
+
+
+class PipelineStage:
+    """Команда конвейера с её перенаправлениями ввода (<) и вывода (>, >>)"""
+    __slots__ = ('cmd', 'args', 'stdin_path', 'stdout_path', 'append')
+
+    def __init__(self, argv: List[str], stdin_path: str = None, stdout_path: str = None, append: bool = False):
+        self.cmd = argv[0]
+        self.args = tuple(argv[1:])
+        self.stdin_path = stdin_path
+        self.stdout_path = stdout_path
+        self.append = append
+
+    @property
+    def redirected(self) -> bool:
+        return self.stdin_path is not None or self.stdout_path is not None
+
+
+def split_pipeline(line: str) -> List[PipelineStage]:
+    """Разбивает строку на команды по | и перенаправления <, >, >>.
+
+    Операторы в кавычках или экранированные обратной косой чертой остаются обычным текстом.
+    """
+    shlex = lazy_import('shlex')
+    tokens = []
+    start = 0
+    quote = None
+    i = 0
+    while i < len(line):
+        ch = line[i]
+        if quote:
+            if ch == quote:
+                quote = None
+            elif ch == '\\' and quote == '"':
+                i += 1
+        elif ch in '\'"':
+            quote = ch
+        elif ch == '\\':
+            i += 1
+        elif ch in '|<>':
+            tokens.extend(shlex.split(line[start:i]))
+            operator = '>>' if line.startswith('>>', i) else ch
+            tokens.append((operator,))
+            i += len(operator)
+            start = i
+            continue
+        i += 1
+    tokens.extend(shlex.split(line[start:]))
+
+    stages = []
+    argv = []
+    redirects = {}
+    tokens = iter(tokens)
+    for token in tokens:
+        if isinstance(token, str):
+            argv.append(token)
+            continue
+        operator = token[0]
+        if operator == '|':
+            if not argv:
+                raise ValueError("синтаксическая ошибка рядом с '|'")
+            stages.append(PipelineStage(argv, **redirects))
+            argv = []
+            redirects = {}
+            continue
+        target = next(tokens, None)
+        if not isinstance(target, str):
+            raise ValueError(f"синтаксическая ошибка рядом с '{operator}'")
+        if operator == '<':
+            redirects['stdin_path'] = target
+        else:
+            redirects['stdout_path'] = target
+            redirects['append'] = operator == '>>'
+    if argv:
+        stages.append(PipelineStage(argv, **redirects))
+    elif stages or redirects:
+        raise ValueError("синтаксическая ошибка: ожидается команда")
+    return stages
+
+
+def _encode_lines(lines):
+    for line in lines:
+        yield (line + '\n').encode('utf-8', errors='surrogateescape')
+
+
+class ScriptStep:
+    """Строка скрипта, уже разобранная на конвейер команд"""
+    __slots__ = ('line_num', 'line', 'stages', 'error')
+
+    def __init__(self, line_num: int, line: str, stages: List[PipelineStage] = (), error: str = None):
+        self.line_num = line_num
+        self.line = line
+        self.stages = stages
+        self.error = error
+
+
+# Скомпилированные скрипты: абсолютный путь -> ((mtime, размер), шаги)
+_script_plans: Dict[str, tuple] = {}
+# Скрипты крупнее не кэшируются, а выполняются потоково с постоянным расходом памяти
+SCRIPT_PLAN_MAX_BYTES = 1024 * 1024
+
+
+# Встроенные команды: имя -> (метод оболочки, метод для конвейера или None).
+# Методы связываются с оболочкой при первом вызове команды, а не в конструкторе
+BUILTIN_COMMANDS = {
+    'ls': ('_cmd_ls', '_stream_ls'),
+    'cd': ('_cmd_cd', None),
+    'exit': ('_cmd_exit', None),
+    'pwd': ('_cmd_pwd', None),
+    'cat': ('_cmd_cat', '_stream_cat'),
+    'rev': ('_cmd_rev', '_stream_rev'),
+    'cal': ('_cmd_cal', None),
+    'vfsstat': ('_cmd_vfsstat', None),
+    'touch': ('_cmd_touch', None),
+    'mkdir': ('_cmd_mkdir', None),
+    'rm': ('_cmd_rm', None),
+    'echo': ('_cmd_echo', '_stream_echo'),
+    'compact': ('_cmd_compact', None),
+    'find': ('_cmd_find', '_stream_find'),
+    'grep': ('_cmd_grep', '_stream_grep'),
+    'du': ('_cmd_du', '_stream_du'),
+    'tree': ('_cmd_tree', '_stream_tree'),
+    'mount': ('_cmd_mount', None),
+}
+# Группа точек входа, через которую установленные пакеты добавляют команды
+PLUGIN_ENTRY_POINT_GROUP = 'vfs_shell.commands'
+# Сторонние команды: имя -> (команда, потоковый вариант или None)
+_plugin_commands = {}
+_entry_points_loaded = False
+
+
+def register_command(name: str, command, stream=None):
+    """Регистрирует стороннюю команду; она заменяет встроенную с тем же именем.
+
+    command - функция(shell, args) -> bool, stream - функция(shell, args, stdin),
+    возвращающая итератор байтовых блоков для конвейера. Вместо функции можно
+    передать строку 'модуль:функция' - модуль импортируется при первом вызове.
+    """
+    _plugin_commands[name] = (command, stream)
 
-    def change_directory(self, path: str) -> bool:
-        if path == '~':
-            path = f"/home/{self._get_real_username()}"
-        elif path == '.':
-            return True
-        elif path == '..':
-            if self.current_path == '/':
-                return True
-            parts = self.current_path.split('/')
-            if len(parts) <= 2:
-                self.current_path = '/'
-            else:
-                self.current_path = '/'.join(parts[:-1]) or '/'
-            return True
 
-        if path.startswith('/'):
-            target = path
-        else:
-            target = f"{self.current_path}/{path}" if self.current_path != '/' else f"/{path}"
+def load_plugin_manifest(manifest_path: str):
+    """Манифест команд: {"имя": "модуль:функция"} или {"имя": {"command": ..., "stream": ...}}"""
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, dict):
+        raise ValueError("манифест команд должен быть JSON-объектом")
+    for name, spec in manifest.items():
+        if isinstance(spec, str):
+            spec = {'command': spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get('command'), str):
+            raise ValueError(f"{name}: ожидается строка 'модуль:функция'")
+        register_command(name, spec['command'], spec.get('stream'))
 
-        parts = [p for p in target.split('/') if p]
-        current = self.root['/']
 
-        for i, part in enumerate(parts):
-            if part not in current:
-                return False
-            current = current[part]
-            if i == len(parts) - 1 and not isinstance(current, dict):
-                return False
+def _load_entry_points():
+    # Поиск установленных пакетов небыстрый, поэтому только когда команда не нашлась
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    metadata = lazy_import('importlib.metadata')
+    for entry_point in metadata.entry_points(group=PLUGIN_ENTRY_POINT_GROUP):
+        _plugin_commands.setdefault(entry_point.name, (entry_point.value, None))
 
-        self.current_path = target
-        return True
 
-    def list_directory(self) -> List[str]:
-        current_dir = self.get_current_dir()
-        return sorted(current_dir.keys()) if isinstance(current_dir, dict) else []
+def _resolve_target(target):
+    if callable(target):
+        return target
+    module_name, _, attr = target.partition(':')
+    obj = lazy_import(module_name)
+    for part in attr.split('.') if attr else ():
+        obj = getattr(obj, part)
+    return obj
 
-    def get_prompt(self) -> str:
-        username = self._get_real_username()
-        hostname = os.getenv('HOSTNAME', 'localhost')
-        display_path = self.current_path
-        home_path = f"/home/{username}"
-        if self.current_path == home_path:
-            display_path = '~'
-        elif self.current_path.startswith(home_path + '/'):
-            display_path = '~' + self.current_path[len(home_path):]
 
-        return f"{username}@{hostname}:{display_path}$ "
+class CommandRegistry:
+    """Команды оболочки: встроенные и сторонние, связываются при первом обращении"""
+
+    def __init__(self, shell):
+        self.shell = shell
+        self._commands = {}
+        self._streams = {}
+        # Сторонняя команда -> время импорта её модуля при первом вызове
+        self.profile = {}
+        # Команды, запрещённые в этой оболочке (сетевые сеансы: SESSION_DENIED_COMMANDS)
+        self.denied = frozenset()
+
+    def __contains__(self, name: str) -> bool:
+        if name in _plugin_commands or name in BUILTIN_COMMANDS:
+            return True
+        _load_entry_points()
+        return name in _plugin_commands
+
+    def __getitem__(self, name: str):
+        if name not in self._commands:
+            self._bind(name)
+        return self._commands[name]
+
+    def stream(self, name: str):
+        """Потоковый вариант команды для конвейера или None"""
+        if name not in self._commands:
+            self._bind(name)
+        return self._streams[name]
+
+    def names(self) -> List[str]:
+        _load_entry_points()
+        return sorted(set(BUILTIN_COMMANDS) | set(_plugin_commands))
+
+    def _bind(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        if name in self.denied:
+            raise ValueError(f"{name}: команда недоступна в этом сеансе")
+        shell = self.shell
+        if name in _plugin_commands:
+            started = time.perf_counter()
+            command, stream = _plugin_commands[name]
+            try:
+                command = _resolve_target(command)
+                stream = _resolve_target(stream) if stream is not None else None
+            except (ImportError, AttributeError) as e:
+                raise ValueError(f"{name}: не удалось загрузить команду: {e}")
+            self._commands[name] = lambda args: command(shell, args)
+            self._streams[name] = (lambda args, stdin: stream(shell, args, stdin)) if stream else None
+            self.profile[name] = time.perf_counter() - started
+        else:
+            # Встроенные команды - методы оболочки; то, что им нужно из библиотек,
+            # импортируется через lazy_import и попадает в import_profile
+            method, stream = BUILTIN_COMMANDS[name]
+            self._commands[name] = getattr(shell, method)
+            self._streams[name] = getattr(shell, stream) if stream else None
 
 
 class ShellEmulator:
-    def __init__(self, vfs_path: str = None, script_path: str = None):
-        self.vfs = VirtualFileSystem(vfs_path)
+    def __init__(self, vfs_path: str = None, script_path: str = None, mounts: Dict[str, str] = None,
+                 out: OutputSink = None, quiet: bool = False, base: 'BaseImage' = None):
+        self.vfs = VirtualFileSystem(vfs_path, mounts, base)
+        self.out = out if out is not None else OutputSink()
+        # Без эха приглашения и команды при выполнении скрипта
+        self.quiet = quiet
         self.vfs_path = vfs_path
         self.script_path = script_path
-        self.commands = {
-            'ls': self._cmd_ls,
-            'cd': self._cmd_cd,
-            'exit': self._cmd_exit,
-            'pwd': self._cmd_pwd,
-            'cat': self._cmd_cat,
-            'rev': self._cmd_rev,
-            'cal': self._cmd_cal,
-        }
+        self.commands = CommandRegistry(self)
 
-    def parse_command(self, line: str) -> tuple[str, List[str]]:
+    def parse_line(self, line: str) -> List[PipelineStage]:
         try:
-            tokens = shlex.split(line)
-            if not tokens:
-                return '', []
-            cmd = tokens[0]
-            args = tokens[1:]
-            return cmd, args
+            return split_pipeline(line)
         except ValueError as e:
             raise ValueError(f"Ошибка парсинга: {e}")
 
@@ -161,38 +2915,110 @@ class ShellEmulator:
 
         return self.commands[cmd](args)
 
+    def execute_line(self, stages: List[PipelineStage]) -> bool:
+        """Выполняет разобранную строку; False - команда exit.
+
+        Одиночная команда пишет прямо в вывод. В конвейере данные идут между
+        командами генераторами блоков по мере чтения, не накапливаясь целиком.
+        """
+        if not stages:
+            return True
+        if len(stages) == 1 and not stages[0].redirected:
+            return self.execute_command(stages[0].cmd, list(stages[0].args))
+        for stage in stages:
+            if stage.cmd not in self.commands:
+                raise ValueError(f"{stage.cmd}: команда не найдена")
+
+        stream = None
+        for stage in stages:
+            if stage.stdin_path is not None:
+                stream = self._file_stream(stage.stdin_path)
+            stream = self._stage_stream(stage, stream)
+            if stage.stdout_path is not None:
+                data = b''.join(stream)
+                try:
+                    self.vfs.write_file(stage.stdout_path, data, stage.append)
+                except ValueError as e:
+                    raise ValueError(f"{stage.cmd}: {e}")
+                stream = iter(())
+        self.out.write_chunks(stream, terminate_empty=False)
+        return True
+
+    def _file_stream(self, path: str):
+        current = self.vfs.resolve(path)
+        if current is None:
+            raise ValueError(f"{path}: Нет такого файла или каталога")
+        if self.vfs.is_dir(current):
+            raise ValueError(f"{path}: Это каталог")
+        return map(bytes, self.vfs.iter_file_chunks(current))
+
+    def _stage_stream(self, stage: PipelineStage, stdin):
+        # Команды без потокового варианта выполняются в конвейере целиком с перехватом вывода
+        stream = self.commands.stream(stage.cmd)
+        if stream is not None:
+            return stream(list(stage.args), stdin)
+        return self._captured(stage.cmd, list(stage.args))
+
+    def _captured(self, cmd: str, args: List[str]):
+        """Вывод команды без потокового режима; выполняется, когда конвейер доходит до неё"""
+        saved = self.out
+        self.out = capture = CaptureSink()
+        try:
+            self.execute_command(cmd, args)
+        finally:
+            self.out = saved
+        data = capture.getvalue().encode('utf-8', errors='surrogateescape')
+        if data:
+            yield data
+
     def _cmd_ls(self, args: List[str]) -> bool:
-        if args:
-            if len(args) == 1:
-                path = args[0]
-                if path.startswith('/'):
-                    target_path = path
+        for line in self._ls_lines(args):
+            self.out.print(line)
+        return True
+
+    def _stream_ls(self, args: List[str], stdin):
+        return _encode_lines(self._ls_lines(args))
+
+    def _ls_lines(self, args: List[str]):
+        offset = 0
+        limit = None
+        paths = []
+        for arg in args:
+            option, _, value = arg.partition('=')
+            if option in ('--offset', '--limit') and value:
+                try:
+                    number = int(value)
+                except ValueError:
+                    number = -1
+                if number < 0:
+                    raise ValueError(f"ls: некорректное значение {option}: {value}")
+                if option == '--offset':
+                    offset = number
                 else:
-                    target_path = f"{self.vfs.current_path}/{path}" if self.current_path != '/' else f"/{path}"
-
-                parts = [p for p in target_path.split('/') if p]
-                current = self.vfs.root['/']
-                for part in parts:
-                    if part not in current:
-                        raise ValueError(
-                            f"ls: невозможно получить доступ к '{target_path}': нет такого файла или каталога")
-                    current = current[part]
-
-                if not isinstance(current, dict):
-                    print(path)
-                    return True
+                    limit = number
+            else:
+                paths.append(arg)
 
-                files = sorted(current.keys())
-                for f in files:
-                    print(f)
-                return True
-            elif len(args) > 1:
-                raise ValueError(f"ls: неподдерживаемые аргументы: {' '.join(args)}")
+        if len(paths) > 1:
+            raise ValueError(f"ls: неподдерживаемые аргументы: {' '.join(args)}")
 
-        files = self.vfs.list_directory()
-        for f in files:
-            print(f)
-        return True
+        if paths:
+            path = paths[0]
+            current = self.vfs.resolve(path)
+            if current is None:
+                raise ValueError(
+                    f"ls: невозможно получить доступ к '{self.vfs.normalize_path(path)}': "
+                    f"нет такого файла или каталога")
+
+            if not self.vfs.is_dir(current):
+                yield path
+                return
+        else:
+            current = self.vfs.get_current_dir()
+            if current is None or not self.vfs.is_dir(current):
+                return
+
+        yield from self.vfs.iter_names(current, offset, limit)
 
     def _cmd_cd(self, args: List[str]) -> bool:
         if len(args) > 1:
@@ -208,33 +3034,336 @@ class ShellEmulator:
     def _cmd_exit(self, args: List[str]) -> bool:
         if args:
             raise ValueError(f"exit: неподдерживаемые аргументы: {' '.join(args)}")
-        print("Выход...")
+        self.out.print("Выход...")
         return False
 
     def _cmd_pwd(self, args: List[str]) -> bool:
         if args:
             raise ValueError(f"pwd: неподдерживаемые аргументы: {' '.join(args)}")
-        print(self.vfs.current_path)
+        self.out.print(self.vfs.current_path)
         return True
 
     def _cmd_cat(self, args: List[str]) -> bool:
-        if len(args) != 1:
-            raise ValueError("cat: требуется один аргумент")
+        for current in self._cat_files(args, None):
+            self.out.write_chunks(self.vfs.iter_file_chunks(current))
+        return True
+
+    def _stream_cat(self, args: List[str], stdin):
+        """cat в конвейере: файлы подряд; без аргументов или '-' - входной поток"""
+        files = self._cat_files(args, stdin)
+
+        def chunks():
+            for current in files:
+                if current is None:
+                    yield from stdin
+                else:
+                    yield from map(bytes, self.vfs.iter_file_chunks(current))
+        return chunks()
 
-        path = args[0]
+    def _cat_files(self, args: List[str], stdin) -> List[Optional[int]]:
+        """Иноды файлов (None - входной поток); все проверяются до начала вывода"""
+        if not args:
+            if stdin is None:
+                raise ValueError("cat: требуется хотя бы один аргумент")
+            return [None]
 
-        # Проверим, существует ли файл
-        parts = [p for p in path.split('/') if p]
-        current = self.vfs.root['/']
-        for part in parts:
-            if part not in current:
+        files = []
+        for path in args:
+            if path == '-' and stdin is not None:
+                files.append(None)
+                continue
+            current = self.vfs.resolve(path)
+            if current is None:
                 raise ValueError(f"cat: {path}: Нет такого файла или каталога")
-            current = current[part]
+            if self.vfs.is_dir(current):
+                raise ValueError(f"cat: {path}: Это каталог, а не файл")
+            files.append(current)
+        return files
+
+    def _cmd_vfsstat(self, args: List[str]) -> bool:
+        if len(args) > 1:
+            raise ValueError(f"vfsstat: неподдерживаемые аргументы: {' '.join(args)}")
+        prefix = args[0] if args else ''
+        for key, value in self.vfs.get_stats().items():
+            if key.startswith(prefix):
+                self.out.print(f"{key}: {value}")
+        return True
 
-        if isinstance(current, dict):
-            raise ValueError(f"cat: {path}: Это каталог, а не файл")
+    def _cmd_touch(self, args: List[str]) -> bool:
+        if not args:
+            raise ValueError("touch: требуется хотя бы один аргумент")
+        for path in args:
+            try:
+                self.vfs.touch(path)
+            except ValueError as e:
+                raise ValueError(f"touch: {e}")
+        return True
+
+    def _cmd_mkdir(self, args: List[str]) -> bool:
+        parents = '-p' in args
+        paths = [arg for arg in args if arg != '-p']
+        if not paths:
+            raise ValueError("mkdir: требуется хотя бы один аргумент")
+        for path in paths:
+            try:
+                self.vfs.make_dir(path, parents)
+            except ValueError as e:
+                if not (parents and 'файл существует' in str(e)):
+                    raise ValueError(f"mkdir: {e}")
+        return True
+
+    def _cmd_rm(self, args: List[str]) -> bool:
+        recursive = False
+        force = False
+        paths = []
+        for arg in args:
+            if arg.startswith('-') and len(arg) > 1 and set(arg[1:]) <= set('rRf'):
+                recursive = recursive or 'r' in arg or 'R' in arg
+                force = force or 'f' in arg
+            else:
+                paths.append(arg)
+        if not paths:
+            raise ValueError("rm: требуется хотя бы один аргумент")
+        for path in paths:
+            if force and self.vfs.resolve(path) is None:
+                continue
+            try:
+                self.vfs.remove(path, recursive)
+            except ValueError as e:
+                raise ValueError(f"rm: {e}")
+        return True
+
+    def _cmd_echo(self, args: List[str]) -> bool:
+        # Перенаправление > и >> разбирается на уровне строки, см. execute_line
+        self.out.print(' '.join(args))
+        return True
+
+    def _stream_echo(self, args: List[str], stdin):
+        return _encode_lines([' '.join(args)])
+
+    def _cmd_find(self, args: List[str]) -> bool:
+        for line in self._find_lines(args):
+            self.out.print(line)
+        return True
+
+    def _stream_find(self, args: List[str], stdin):
+        return _encode_lines(self._find_lines(args))
+
+    def _find_lines(self, args: List[str]) -> List[str]:
+        path = '.'
+        name = None
+        kind = None
+        i = 0
+        if args and not args[0].startswith('-'):
+            path = args[0]
+            i = 1
+        while i < len(args):
+            option = args[i]
+            if option not in ('-name', '-type') or i + 1 >= len(args):
+                raise ValueError(f"find: неподдерживаемые аргументы: {' '.join(args[i:])}")
+            value = args[i + 1]
+            if option == '-name':
+                name = value
+            elif value in ('f', 'd'):
+                kind = value
+            else:
+                raise ValueError(f"find: неизвестный тип: {value}")
+            i += 2
+
+        try:
+            found = self.vfs.find(path, name, kind)
+        except ValueError as e:
+            raise ValueError(f"find: {e}")
+        start = self.vfs.normalize_path(path)
+        return [self._display_path(path, start, result) for result in found]
+
+    @staticmethod
+    def _display_path(arg: str, start: str, result: str) -> str:
+        """Путь результата относительно аргумента команды, как в find(1) и grep(1)"""
+        if arg.startswith('/') or result == start:
+            return result if arg.startswith('/') else arg
+        return arg.rstrip('/') + result[len(start.rstrip('/')):]
+
+    def _cmd_grep(self, args: List[str]) -> bool:
+        self.out.write_chunks(self._stream_grep(args, None), terminate_empty=False)
+        return True
+
+    def _stream_grep(self, args: List[str], stdin):
+        """Совпавшие строки блоками байтов; без ПУТИ - строки входного потока"""
+        options = []
+        while args and args[0] in ('-r', '-n', '-rn', '-nr'):
+            options.extend(args[0][1:])
+            args = args[1:]
+        if len(args) < 2 and not (len(args) == 1 and stdin is not None):
+            raise ValueError("grep: использование: grep [-r] [-n] ШАБЛОН ПУТЬ...")
+        pattern, paths = args[0], args[1:]
+        recursive = 'r' in options
+        with_names = recursive or len(paths) > 1
+        try:
+            regex = re.compile(pattern.encode('utf-8'))
+        except re.error as e:
+            raise ValueError(f"grep: неверное регулярное выражение: {e}")
+
+        def matches():
+            if not paths:
+                for number, line in enumerate(iter_lines(stdin), 1):
+                    if regex.search(line):
+                        yield (f"{number}:".encode() if 'n' in options else b'') + line + b'\n'
+                return
+            for path in paths:
+                start = self.vfs.normalize_path(path)
+                try:
+                    for found, number, line in self.vfs.grep(pattern, path, recursive):
+                        prefix = ''
+                        if with_names:
+                            prefix = f"{self._display_path(path, start, found)}:"
+                        if 'n' in options:
+                            prefix += f"{number}:"
+                        yield prefix.encode('utf-8') + line + b'\n'
+                except ValueError as e:
+                    raise ValueError(f"grep: {e}")
+        return matches()
 
-        print(current)
+    @staticmethod
+    def _human_size(size: int) -> str:
+        if size < 1024:
+            return str(size)
+        value = float(size)
+        for unit in 'KMGTP':
+            value /= 1024
+            if value < 1024 or unit == 'P':
+                break
+        return f"{value:.1f}{unit}" if value < 10 else f"{value:.0f}{unit}"
+
+    def _cmd_du(self, args: List[str]) -> bool:
+        for line in self._du_lines(args):
+            self.out.print(line)
+        return True
+
+    def _stream_du(self, args: List[str], stdin):
+        return _encode_lines(self._du_lines(args))
+
+    def _du_lines(self, args: List[str]):
+        flags = set()
+        paths = []
+        for arg in args:
+            if arg == '--inodes':
+                flags.add('i')
+            elif arg.startswith('-') and len(arg) > 1 and set(arg[1:]) <= {'s', 'h'}:
+                flags.update(arg[1:])
+            elif arg.startswith('-'):
+                raise ValueError(f"du: неизвестный параметр: {arg}")
+            else:
+                paths.append(arg)
+
+        def line(ino: int, shown: str):
+            size, files = self.vfs.totals(ino)
+            if 'i' in flags:
+                value = str(files)
+            else:
+                value = self._human_size(size) if 'h' in flags else str(size)
+            return f"{value}\t{shown}"
+
+        for path in paths or ['.']:
+            start = self.vfs.resolve(path)
+            if start is None:
+                raise ValueError(f"du: '{path}': нет такого файла или каталога")
+            if 's' in flags or not self.vfs.is_dir(start):
+                yield line(start, path)
+                continue
+            # Каталоги выводятся после своих подкаталогов, как в du(1)
+            start_path = self.vfs.normalize_path(path)
+            stack = [(start, start_path, False)]
+            while stack:
+                ino, current, expanded = stack.pop()
+                if expanded:
+                    yield line(ino, self._display_path(path, start_path, current))
+                    continue
+                stack.append((ino, current, True))
+                base = current.rstrip('/')
+                children = list(zip(self.vfs.fs.child_names(ino), self.vfs.fs.children(ino)))
+                for name, child in reversed(children):
+                    if self.vfs.is_dir(child):
+                        stack.append((child, f"{base}/{name}", False))
+
+    def _cmd_tree(self, args: List[str]) -> bool:
+        for line in self._tree_lines(args):
+            self.out.print(line)
+        return True
+
+    def _stream_tree(self, args: List[str], stdin):
+        return _encode_lines(self._tree_lines(args))
+
+    def _tree_lines(self, args: List[str]):
+        depth = None
+        paths = []
+        i = 0
+        while i < len(args):
+            if args[i] == '-L':
+                value = args[i + 1] if i + 1 < len(args) else ''
+                if not value.isdigit() or int(value) < 1:
+                    raise ValueError(f"tree: некорректный уровень: {value}")
+                depth = int(value)
+                i += 2
+            elif args[i].startswith('-'):
+                raise ValueError(f"tree: неизвестный параметр: {args[i]}")
+            else:
+                paths.append(args[i])
+                i += 1
+        if len(paths) > 1:
+            raise ValueError(f"tree: неподдерживаемые аргументы: {' '.join(args)}")
+
+        path = paths[0] if paths else '.'
+        start = self.vfs.resolve(path)
+        if start is None or not self.vfs.is_dir(start):
+            raise ValueError(f"tree: '{path}': нет такого каталога")
+
+        fs = self.vfs.fs
+        yield path
+        dirs = files = 0
+        # Стек открытых каталогов: имена, иноды, позиция и отступ; строки выводятся по мере обхода
+        stack = [(list(fs.child_names(start)), fs.children(start), [0], '')]
+        while stack:
+            names, inodes, position, indent = stack[-1]
+            i = position[0]
+            if i >= len(names):
+                stack.pop()
+                continue
+            position[0] += 1
+            last = i == len(names) - 1
+            yield f"{indent}{'└── ' if last else '├── '}{names[i]}"
+            child = inodes[i]
+            if fs.is_dir(child):
+                dirs += 1
+                if depth is None or len(stack) < depth:
+                    stack.append((list(fs.child_names(child)), fs.children(child), [0],
+                                  indent + ('    ' if last else '│   ')))
+            else:
+                files += 1
+        yield f"\n{dirs} directories, {files} files"
+
+    def _cmd_mount(self, args: List[str]) -> bool:
+        if not args:
+            for image_path, path, loaded in self.vfs.mount_points():
+                self.out.print(f"{image_path} on {path} ({'загружен' if loaded else 'не загружен'})")
+            return True
+        if len(args) != 2:
+            raise ValueError("mount: использование: mount ОБРАЗ КАТАЛОГ")
+        try:
+            self.vfs.mount(args[0], args[1])
+        except ValueError as e:
+            raise ValueError(f"mount: {e}")
+        return True
+
+    def _cmd_compact(self, args: List[str]) -> bool:
+        if args:
+            raise ValueError(f"compact: неподдерживаемые аргументы: {' '.join(args)}")
+        try:
+            stats = self.vfs.compact()
+        except (OSError, ValueError) as e:
+            raise ValueError(f"compact: {e}")
+        self.out.print(f"Журнал свёрнут: записей {stats['records']}, узлов {stats['nodes']}, "
+                       f"размер образа {stats['image_bytes']} байт")
         return True
 
     def _cmd_rev(self, args: List[str]) -> bool:
@@ -243,10 +3372,20 @@ class ShellEmulator:
 
         text = args[0]
         reversed_text = text[::-1]
-        print(reversed_text)
+        self.out.print(reversed_text)
         return True
 
+    def _stream_rev(self, args: List[str], stdin):
+        """rev в конвейере: без аргумента переворачивает каждую строку входного потока"""
+        if args or stdin is None:
+            if len(args) != 1:
+                raise ValueError("rev: требуется один аргумент")
+            return _encode_lines([args[0][::-1]])
+        lines = (line.decode('utf-8', errors='surrogateescape')[::-1] for line in iter_lines(stdin))
+        return _encode_lines(lines)
+
     def _cmd_cal(self, args: List[str]) -> bool:
+        calendar = lazy_import('calendar')
         if len(args) > 2:
             raise ValueError("cal: неподдерживаемые аргументы")
 
@@ -279,79 +3418,118 @@ class ShellEmulator:
             year = calendar.datetime.date.today().year
 
         if month is not None:
-            print(calendar.month(year, month))
+            self.out.print(calendar.month(year, month))
         else:
-            print(calendar.calendar(year))
+            self.out.print(calendar.calendar(year))
+
+        return True
+
+    def _parse_script(self, lines):
+        """Шаги скрипта; ошибка разбора строки сохраняется и сообщается, когда до неё дойдёт выполнение"""
+        for line_num, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                stages = self.parse_line(line)
+            except ValueError as e:
+                yield ScriptStep(line_num, line, error=str(e))
+            else:
+                yield ScriptStep(line_num, line, stages)
 
+    def compile_script(self, script_path: str) -> List[ScriptStep]:
+        """План выполнения скрипта из кэша по пути и mtime; при изменении файла разбирается заново"""
+        path = os.path.abspath(script_path)
+        key = _stat_key(path)
+        cached = _script_plans.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            steps = list(self._parse_script(f))
+        _script_plans[path] = (key, steps)
+        return steps
+
+    def _run_steps(self, steps) -> bool:
+        """Выполняет шаги по одному по мере поступления; False - ошибка в скрипте"""
+        name = 'stdin' if self.script_path == '-' else self.script_path
+        for step in steps:
+            if not self.quiet:
+                self.out.print(f"{self.vfs.get_prompt()} {step.line}")
+
+            try:
+                if step.error is not None:
+                    raise ValueError(step.error)
+                if not self.execute_line(step.stages):
+                    return True
+                self.out.command_done()
+            except Exception as e:
+                self.out.print(f"{e}")
+                self.out.print(f"Ошибка в скрипте {name} на строке {step.line_num}: {step.line}")
+                return False
         return True
 
-    def run_script(self) -> bool:
-        """Выполняет стартовый скрипт"""
+    def run_script(self, compiled: bool = True) -> bool:
+        """Выполняет стартовый скрипт; '-' - чтение из stdin.
+
+        Небольшие скрипты идут по скомпилированному плану, крупные и stdin читаются
+        построчно, не загружаясь в память. compiled=False разбирает каждую строку заново.
+        """
         if not self.script_path:
             return False
 
         try:
+            if self.script_path == '-':
+                return self._run_steps(self._parse_script(sys.stdin))
+            if compiled and os.path.getsize(self.script_path) <= SCRIPT_PLAN_MAX_BYTES:
+                return self._run_steps(self.compile_script(self.script_path))
             with open(self.script_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-
-            for line_num, line in enumerate(lines, 1):
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-
-                prompt = self.vfs.get_prompt()
-                print(f"{prompt} {line}")
-
-                try:
-                    cmd, args = self.parse_command(line)
-                    if not self.execute_command(cmd, args):
-                        return True
-                except Exception as e:
-                    print(f"{e}")
-                    print(f"Ошибка в скрипте {self.script_path} на строке {line_num}: {line}")
-                    return False
+                return self._run_steps(self._parse_script(f))
 
         except FileNotFoundError:
-            print(f"Ошибка: файл скрипта не найден: {self.script_path}")
+            self.out.print(f"Ошибка: файл скрипта не найден: {self.script_path}")
             return False
         except Exception as e:
-            print(f"Ошибка при выполнении скрипта: {e}")
+            self.out.print(f"Ошибка при выполнении скрипта: {e}")
             return False
 
-        return True
-
     def run(self):
-        print("Эмулятор оболочки UNIX (Этап 2)")
-        print(f"VFS путь: {self.vfs_path or 'по умолчанию'}")
-        print(f"Скрипт: {self.script_path or 'не задан'}")
-        print("Введите 'exit' для выхода.\n")
+        try:
+            self._run()
+        finally:
+            self.out.flush()
+
+    def _run(self):
+        self.out.print("Эмулятор оболочки UNIX (Этап 2)")
+        self.out.print(f"VFS путь: {self.vfs_path or 'по умолчанию'}")
+        self.out.print(f"Скрипт: {self.script_path or 'не задан'}")
+        self.out.print("Введите 'exit' для выхода.\n")
 
         if self.script_path:
             success = self.run_script()
-            if not success:
+            # Скрипт из stdin заменяет интерактивный ввод
+            if not success or self.script_path == '-':
                 return
 
         while True:
             prompt = self.vfs.get_prompt()
+            self.out.flush()
             try:
                 line = input(prompt).strip()
             except EOFError:
-                print()
+                self.out.print()
                 break
             except KeyboardInterrupt:
-                print()
+                self.out.print()
                 continue
 
             if not line:
                 continue
 
             try:
-                cmd, args = self.parse_command(line)
-                if not self.execute_command(cmd, args):
+                if not self.execute_line(self.parse_line(line)):
                     break
             except Exception as e:
-                print(f"{e}")
-                sys.stdout.flush()
+                self.out.print(f"{e}")
                 continue
 
 
@@ -360,27 +3538,712 @@ def print_usage():
     print("Использование:")
     print("  python emulator.py [vfs_path] [script_path]")
     print("  vfs_path   - путь к JSON-файлу с VFS")
-    print("  script_path - путь к стартовому скрипту")
+    print("  script_path - путь к стартовому скрипту или '-' для чтения команд из stdin")
+    print("  python emulator.py pack [--compress] <vfs.json> <vfs.img> - собрать бинарный образ VFS")
+    print("  python emulator.py unpack <vfs.img> <vfs.json> - выгрузить образ обратно в JSON")
+    print("  python emulator.py compact <vfs>               - свернуть журнал изменений в образ")
+    print("  python emulator.py build-vfs [--compress] [--jobs=N] <каталог> <vfs.json> - собрать VFS из каталога")
+    print("  python emulator.py bench-script [--repeat=N] <vfs_path> <script_path> - сравнить время выполнения")
+    print("  python emulator.py batch [--jobs=N] [--output=DIR] <batch_jobs.json> - выполнить пакет заданий")
+    print("  python emulator.py serve [--host=H] [--port=N | --unix=PATH] [--idle-timeout=S] [--write-timeout=S]")
+    print("                     [--workers=N] [--mounts=<manifest.json>] [vfs_path] - сервер сеансов оболочки на сокете")
+    print("  python emulator.py fork-server [--unix=PATH] [--warm=N] [--mounts=<manifest.json>] [vfs_path]")
+    print("                     - сеансы в заранее запущенных дочерних процессах (только Unix)")
+    print("  --quiet          - не выводить приглашение и команду перед каждой строкой скрипта")
+    print("  --flush=always|command|full - когда сбрасывать буфер вывода (по умолчанию command для")
+    print("                     терминала, full при выводе в файл или канал)")
+    print("  python emulator.py --mounts <manifest.json> [vfs_path] [script_path] - подключить образы из манифеста (root в манифесте заменяет vfs_path)")
+    print("  --plugins=<manifest.json> - сторонние команды {\"имя\": \"модуль:функция\"}, импортируются при первом вызове")
+    print("  --startup-profile - выполнить скрипт без интерактивного режима и вывести время импорта")
+    print("                     и инициализации по компонентам")
     print("\nПримеры:")
     print("  python emulator.py")
     print("  python emulator.py vfs.json")
     print("  python emulator.py vfs.json start_script.txt")
 
 
+def run_image_tool(args: List[str]):
+    """pack/unpack/compact/build-vfs: конвертация между JSON-схемой и бинарным образом VFS,
+    сворачивание журнала, сборка VFS из каталога хост-системы"""
+    compress = '--compress' in args[1:]
+    args = [arg for arg in args if arg != '--compress']
+    jobs = None
+    for arg in [arg for arg in args if arg.startswith('--jobs=')]:
+        jobs = int(arg[7:]) if arg[7:].isdigit() and int(arg[7:]) > 0 else -1
+        args.remove(arg)
+    expected = 2 if args[0] == 'compact' else 3
+    if (len(args) != expected or (compress and args[0] not in ('pack', 'build-vfs'))
+            or (jobs is not None and (args[0] != 'build-vfs' or jobs < 0))):
+        print_usage()
+        sys.exit(1)
+    command, source, target = (args + [None])[:3]
+    started = time.perf_counter()
+    try:
+        if command == 'compact':
+            stats = VirtualFileSystem(source).compact()
+            print(f"Журнал свёрнут: записей {stats['records']}, узлов {stats['nodes']}, "
+                  f"размер образа {stats['image_bytes']} байт")
+        elif command == 'pack':
+            stats = pack_image(source, target, compress)
+            print(f"Упаковано узлов: {stats['nodes']}, размер образа: {stats['image_bytes']} байт")
+            print(f"Уникальных блобов: {stats['blob_unique']} из {stats['blob_refs']}, "
+                  f"сэкономлено {stats['dedup_bytes_saved']} байт (x{stats['dedup_ratio']})")
+        elif command == 'build-vfs':
+            stats = build_vfs(source, target, compress, jobs)
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            print(f"Собрано каталогов: {stats['dirs']}, файлов: {stats['files']}, "
+                  f"размер JSON: {stats['json_bytes']} байт, процессов: {stats['jobs']}")
+            print(f"Скорость: {stats['files'] / elapsed:.0f} файлов/с")
+        else:
+            nodes = unpack_image(source, target)
+            print(f"Распаковано узлов: {nodes}")
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    print(f"Время: {time.perf_counter() - started:.3f} с")
+
+
+def load_batch_manifest(manifest_path: str) -> List[Dict]:
+    """Задания пакета: [{"name", "vfs" (null - VFS по умолчанию), "script", "expect": "ok"|"error"}].
+
+    Относительные пути считаются от каталога манифеста.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise ValueError(f"{manifest_path}: ожидается список заданий")
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    for number, entry in enumerate(manifest, 1):
+        if not isinstance(entry, dict) or not entry.get('script'):
+            raise ValueError(f"{manifest_path}: задание {number}: не указан script")
+        expect = entry.get('expect', 'ok')
+        if expect not in ('ok', 'error'):
+            raise ValueError(f"{manifest_path}: задание {number}: expect должен быть ok или error")
+        jobs.append({
+            'name': entry.get('name') or os.path.basename(entry['script']),
+            'vfs': os.path.join(folder, entry['vfs']) if entry.get('vfs') else None,
+            'script': os.path.join(folder, entry['script']),
+            'expect': expect,
+        })
+    return jobs
+
+
+def _run_batch_job(vfs_path: Optional[str], script_path: str) -> Dict[str, object]:
+    """Выполняет задание в рабочем процессе с перехватом вывода.
+
+    Образы кэшируются в процессе, так что каждый образ загружается рабочим один раз.
+    """
+    cached = vfs_path is not None and os.path.abspath(vfs_path) in _base_images
+    output = CaptureSink()
+    started = time.perf_counter()
+    try:
+        emulator = ShellEmulator(vfs_path, script_path, out=output)
+        # Задания не сохраняют изменений: общий образ и его журнал остаются нетронутыми
+        emulator.vfs.journal = None
+        ok = emulator.run_script()
+    except Exception as e:
+        output.print(f"Ошибка: {e}")
+        ok = False
+    return {'ok': ok, 'seconds': time.perf_counter() - started, 'output': output.getvalue(),
+            'cached': cached, 'pid': os.getpid()}
+
+
+def run_batch(args: List[str]):
+    """batch [--jobs=N] [--output=DIR] <manifest.json>: задания в пуле процессов и сводный отчёт"""
+    jobs_count = None
+    output_dir = None
+    for arg in list(args):
+        if arg.startswith('--jobs='):
+            jobs_count = int(arg[7:]) if arg[7:].isdigit() and int(arg[7:]) > 0 else -1
+            args.remove(arg)
+        elif arg.startswith('--output='):
+            output_dir = arg[9:]
+            args.remove(arg)
+    if len(args) != 1 or (jobs_count is not None and jobs_count < 0) or output_dir == '':
+        print_usage()
+        sys.exit(1)
+    try:
+        jobs = load_batch_manifest(args[0])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+
+    jobs_count = min(jobs_count or os.cpu_count() or 1, max(len(jobs), 1))
+    started = time.perf_counter()
+    if jobs_count > 1:
+        with lazy_import('concurrent.futures').ProcessPoolExecutor(jobs_count) as pool:
+            futures = [pool.submit(_run_batch_job, job['vfs'], job['script']) for job in jobs]
+            results = [future.result() for future in futures]
+    else:
+        results = [_run_batch_job(job['vfs'], job['script']) for job in jobs]
+    elapsed = time.perf_counter() - started
+
+    passed = 0
+    width = max((len(job['name']) for job in jobs), default=0)
+    for number, (job, result) in enumerate(zip(jobs, results), 1):
+        success = result['ok'] == (job['expect'] == 'ok')
+        passed += success
+        if job['vfs'] is None:
+            source = 'VFS по умолчанию'
+        else:
+            source = 'образ из кэша процесса' if result['cached'] else 'образ загружен'
+        print(f"[{'PASS' if success else 'FAIL'}] {job['name']:<{width}}  {result['seconds']:.3f} с  "
+              f"(процесс {result['pid']}, {source})")
+        if output_dir:
+            safe_name = re.sub(r'[^\w.-]', '_', job['name'])
+            with open(os.path.join(output_dir, f"{number:02d}_{safe_name}.out"), 'w', encoding='utf-8') as f:
+                f.write(result['output'])
+        elif not success:
+            for line in result['output'].splitlines()[-10:]:
+                print(f"    {line}")
+
+    total = sum(result['seconds'] for result in results)
+    print(f"\nИтого: прошло {passed} из {len(jobs)}, провалено {len(jobs) - passed}")
+    print(f"Время заданий: {total:.3f} с, общее время: {elapsed:.3f} с, процессов: {jobs_count}")
+    if passed != len(jobs):
+        sys.exit(1)
+
+
+def run_script_benchmark(args: List[str]):
+    """Сравнивает выполнение скрипта с разбором каждой строки и по скомпилированному плану.
+
+    Вывод команд подавляется, изменения VFS откатываются после каждого прогона и не пишутся в журнал.
+    """
+    repeat = 20
+    for arg in [arg for arg in args if arg.startswith('--repeat=')]:
+        repeat = int(arg[9:]) if arg[9:].isdigit() and int(arg[9:]) > 0 else 0
+        args.remove(arg)
+    if len(args) != 2 or not repeat:
+        print_usage()
+        sys.exit(1)
+    vfs_path, script_path = args
+    try:
+        emulator = ShellEmulator(vfs_path, script_path)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    emulator.vfs.journal = None
+    snapshot = emulator.vfs.snapshot()
+
+    def timed(compiled: bool) -> float:
+        emulator.out = CaptureSink()
+        started = time.perf_counter()
+        emulator.run_script(compiled)
+        elapsed = time.perf_counter() - started
+        emulator.vfs.restore(snapshot)
+        return elapsed
+
+    _script_plans.pop(os.path.abspath(script_path), None)
+    started = time.perf_counter()
+    steps = emulator.compile_script(script_path)
+    compile_time = time.perf_counter() - started
+    # Прогрев: кэши путей и содержимого одинаково заполнены для обоих режимов
+    timed(True)
+    results = {}
+    for mode in (False, True):
+        results[mode] = min(timed(mode) for _ in range(repeat))
+    print(f"Скрипт: {script_path}, команд: {len(steps)}, прогонов: {repeat}")
+    print(f"Компиляция: {compile_time * 1000:.3f} мс (один раз на путь и mtime)")
+    print(f"Интерпретация: {results[False] * 1000:.3f} мс за прогон")
+    print(f"По плану:      {results[True] * 1000:.3f} мс за прогон")
+    print(f"Ускорение: x{results[False] / max(results[True], 1e-9):.2f}")
+
+
+# Порог буфера записи сокета сеанса: выше него вывод команды ждёт, пока клиент примет данные
+SESSION_WRITE_LIMIT = 256 * 1024
+# Закрыть сеанс, если клиент столько секунд ничего не присылает
+SESSION_IDLE_TIMEOUT = 300.0
+# Закрыть сеанс, если клиент столько секунд не принимает вывод
+SESSION_WRITE_TIMEOUT = 30.0
+# Потоки для команд сеансов. Одновременно выполняются не больше --workers команд;
+# команда, ждущая медленного клиента, держит поток, но не рабочий слот
+SERVE_MAX_THREADS = 1024
+SERVE_DEFAULT_PORT = 8023
+# Команды, недоступные клиентам serve и fork-server: mount открыл бы любой путь хоста
+# и загрузил бы образ в общий кэш процесса, compact переписал бы образ на диске.
+# Подключения задаются только манифестом --mounts при запуске сервера
+SESSION_DENIED_COMMANDS = frozenset(('mount', 'compact'))
+# Очередь ожидающих соединений: при массовом подключении сеансов 100 по умолчанию мало
+SERVE_BACKLOG = 4096
+
+
+class SessionStream:
+    """Поток вывода сеанса serve для OutputSink; в него пишет команда из рабочего потока.
+
+    Данные копятся до SESSION_WRITE_LIMIT и передаются циклу событий с ожиданием drain.
+    На время ожидания команда отдаёт рабочий слот (slots) другим сеансам: медленный
+    клиент задерживает только свою команду, а не цикл, не остальные сеансы и не память.
+    """
+
+    def __init__(self, writer, loop, timeout: float, slots):
+        self.writer = writer
+        self.loop = loop
+        self.timeout = timeout
+        self.slots = slots
+        self.closed = False
+        # write_chunks пишет байты в stream.buffer, текст и байты принимает один метод
+        self.buffer = self
+        self._pending = bytearray()
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionError("клиент отключился")
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='replace')
+        self._pending += data
+        if len(self._pending) >= SESSION_WRITE_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if not self._pending or self.closed:
+            return
+        data = bytes(self._pending)
+        self._pending.clear()
+        asyncio = lazy_import('asyncio')
+        sent = asyncio.run_coroutine_threadsafe(self._send(data), self.loop)
+        self.slots.release()
+        try:
+            sent.result()
+        except (OSError, asyncio.TimeoutError) as e:
+            self.closed = True
+            raise ConnectionError(f"клиент не принимает вывод: {e}")
+        finally:
+            self.slots.acquire()
+
+    async def _send(self, data: bytes):
+        self.writer.write(data)
+        await lazy_import('asyncio').wait_for(self.writer.drain(), self.timeout)
+
+
+def _execute_session_line(shell: 'ShellEmulator', line: str, slots) -> bool:
+    """Строка сеанса в потоке пула, в пределах рабочего слота; False - exit или клиент отключился"""
+    slots.acquire()
+    try:
+        try:
+            keep_going = shell.execute_line(shell.parse_line(line))
+        except ConnectionError:
+            raise
+        except Exception as e:
+            shell.out.print(f"{e}")
+            keep_going = True
+        shell.out.flush()
+        return keep_going
+    except ConnectionError:
+        return False
+    finally:
+        slots.release()
+
+
+async def _serve_session(reader, writer, vfs_path: Optional[str], base: Optional[BaseImage],
+                         mounts: Optional[Dict[str, str]], executor, slots, idle_timeout: float,
+                         write_timeout: float, stats: Dict[str, int]):
+    asyncio = lazy_import('asyncio')
+    loop = asyncio.get_running_loop()
+    writer.transport.set_write_buffer_limits(high=SESSION_WRITE_LIMIT)
+    stats['active'] += 1
+    stats['sessions'] += 1
+
+    async def send(text: str):
+        writer.write(text.encode('utf-8', errors='replace'))
+        await asyncio.wait_for(writer.drain(), write_timeout)
+
+    try:
+        stream = SessionStream(writer, loop, write_timeout, slots)
+        # Оболочка создаётся в пуле: подключение образов из манифеста обращается к диску
+        shell = await loop.run_in_executor(executor, lambda: ShellEmulator(
+            vfs_path, mounts=mounts, out=OutputSink(stream, flush_policy='command'), base=base))
+        # Общий образ только для чтения: изменения остаются в оверлее сеанса
+        shell.vfs.journal = None
+        shell.commands.denied = SESSION_DENIED_COMMANDS
+        await send("Эмулятор оболочки UNIX (Этап 2)\n"
+                   f"VFS путь: {vfs_path or 'по умолчанию'}\n"
+                   "Введите 'exit' для выхода.\n\n")
+        while True:
+            await send(shell.vfs.get_prompt())
+            try:
+                line = await asyncio.wait_for(reader.readline(), idle_timeout)
+            except asyncio.TimeoutError:
+                stats['timeouts'] += 1
+                await send(f"\nСеанс закрыт: нет ввода {idle_timeout:g} с\n")
+                break
+            except ValueError:
+                await send("\nСеанс закрыт: слишком длинная строка\n")
+                break
+            if not line:
+                break
+            line = line.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            stats['commands'] += 1
+            if not await loop.run_in_executor(executor, _execute_session_line, shell, line, slots):
+                break
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        stats['active'] -= 1
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def serve(vfs_path: Optional[str] = None, mounts: Dict[str, str] = None, host: str = '127.0.0.1',
+                port: int = SERVE_DEFAULT_PORT, unix_path: str = None,
+                idle_timeout: float = SESSION_IDLE_TIMEOUT, write_timeout: float = SESSION_WRITE_TIMEOUT,
+                workers: int = None):
+    """Сервер сеансов оболочки на TCP- или Unix-сокете в одном процессе.
+
+    Все сеансы работают поверх одного загруженного образа (open_base_image), у каждого
+    свои текущий каталог и оверлей изменений. Команды выполняются в пуле потоков,
+    одновременно не больше workers (по умолчанию как у ThreadPoolExecutor).
+    """
+    asyncio = lazy_import('asyncio')
+    futures = lazy_import('concurrent.futures')
+    # Образ загружается один раз до приёма соединений и закрепляется за всеми сеансами:
+    # изменения файла или журнала на диске не вызывают перезагрузку в цикле событий
+    base = open_base_image(vfs_path) if vfs_path else None
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    executor = futures.ThreadPoolExecutor(SERVE_MAX_THREADS, thread_name_prefix='session')
+    slots = lazy_import('threading').BoundedSemaphore(workers)
+    stats = {'active': 0, 'sessions': 0, 'commands': 0, 'timeouts': 0}
+
+    async def handle(reader, writer):
+        await _serve_session(reader, writer, vfs_path, base, mounts, executor, slots, idle_timeout,
+                             write_timeout, stats)
+
+    if unix_path:
+        server = await asyncio.start_unix_server(handle, unix_path, backlog=SERVE_BACKLOG)
+        address = unix_path
+    else:
+        server = await asyncio.start_server(handle, host, port, backlog=SERVE_BACKLOG)
+        address = ', '.join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in server.sockets)
+    print(f"Сервер слушает {address}, VFS: {vfs_path or 'по умолчанию'}, "
+          f"таймаут бездействия {idle_timeout:g} с, записи {write_timeout:g} с, команд одновременно {workers}",
+          flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(f"Сервер остановлен: сеансов {stats['sessions']}, команд {stats['commands']}, "
+              f"закрыто по таймауту {stats['timeouts']}", flush=True)
+
+
+def run_server(args: List[str]):
+    """serve [--host=H] [--port=N | --unix=PATH] [--idle-timeout=S] [--write-timeout=S] [--workers=N]
+    [--mounts=M] [vfs_path]"""
+    options = {}
+    mounts = None
+    vfs_path = None
+    try:
+        for arg in list(args):
+            if arg.startswith('--host='):
+                options['host'] = arg[7:]
+            elif arg.startswith('--port='):
+                options['port'] = int(arg[7:])
+            elif arg.startswith('--unix='):
+                options['unix_path'] = arg[7:]
+            elif arg.startswith('--idle-timeout='):
+                options['idle_timeout'] = float(arg[15:])
+                if options['idle_timeout'] <= 0:
+                    raise ValueError("таймаут должен быть положительным")
+            elif arg.startswith('--write-timeout='):
+                options['write_timeout'] = float(arg[16:])
+                if options['write_timeout'] <= 0:
+                    raise ValueError("таймаут должен быть положительным")
+            elif arg.startswith('--workers='):
+                options['workers'] = int(arg[10:])
+                if options['workers'] <= 0:
+                    raise ValueError("число потоков должно быть положительным")
+            elif arg.startswith('--mounts='):
+                vfs_path, mounts = load_manifest(arg[9:])
+            else:
+                continue
+            args.remove(arg)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    # Корневой образ из манифеста занимает место позиционного vfs_path
+    if len(args) > (0 if vfs_path else 1) or any(arg.startswith('--') for arg in args):
+        print_usage()
+        sys.exit(1)
+    if args:
+        vfs_path = args[0]
+    try:
+        lazy_import('asyncio').run(serve(vfs_path, mounts, **options))
+    except KeyboardInterrupt:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+
+
+FORK_SERVER_WARM = 2
+
+
+def _fork_worker(listener, status_fd: int, vfs_path: Optional[str], base: Optional[BaseImage],
+                 mounts: Optional[Dict[str, str]], forked_at: float, conn=None):
+    """Дочерний процесс fork-server: готовит оболочку заранее, затем ждёт своё соединение.
+
+    Сокет сеанса подставляется вместо stdin/stdout, так что сеанс идёт обычным
+    интерактивным циклом run() - как у отдельного процесса main4.py.
+    """
+    signal = lazy_import('signal')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    shell = ShellEmulator(vfs_path, None, mounts, base=base)
+    # Сеансы не сохраняют изменений: общий образ в памяти родителя и его журнал неизменны
+    shell.vfs.journal = None
+    shell.commands.denied = SESSION_DENIED_COMMANDS
+    pid = os.getpid()
+    os.write(status_fd, f"ready {pid} {(time.perf_counter() - forked_at) * 1000:.3f}\n".encode())
+    if conn is None:
+        conn, _ = listener.accept()
+    accepted = time.perf_counter()
+    listener.close()
+    os.dup2(conn.fileno(), 0)
+    os.dup2(conn.fileno(), 1)
+    conn.close()
+    sys.stdin = os.fdopen(0, 'r', encoding='utf-8', errors='replace')
+    sys.stdout = os.fdopen(1, 'w', encoding='utf-8', errors='replace')
+    shell.out = OutputSink(flush_policy='command')
+    os.write(status_fd, f"busy {pid} {(time.perf_counter() - accepted) * 1000:.3f}\n".encode())
+    os.close(status_fd)
+    try:
+        shell.run()
+    except OSError:
+        pass
+
+
+def run_fork_server(args: List[str]):
+    """fork-server [--unix=PATH] [--warm=N] [--mounts=M] [vfs_path]: сеансы в заранее
+    запущенных дочерних процессах, разделяющих загруженный образ через copy-on-write"""
+    if not hasattr(os, 'fork'):
+        print("Ошибка: fork-server доступен только в Unix")
+        sys.exit(1)
+    unix_path = 'vfs-shell.sock'
+    warm = FORK_SERVER_WARM
+    mounts = None
+    vfs_path = None
+    try:
+        for arg in list(args):
+            if arg.startswith('--unix='):
+                unix_path = arg[7:]
+            elif arg.startswith('--warm='):
+                warm = int(arg[7:])
+                if warm < 0:
+                    raise ValueError("число процессов не может быть отрицательным")
+            elif arg.startswith('--mounts='):
+                vfs_path, mounts = load_manifest(arg[9:])
+            else:
+                continue
+            args.remove(arg)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    if len(args) > (0 if vfs_path else 1) or any(arg.startswith('--') for arg in args):
+        print_usage()
+        sys.exit(1)
+    if args:
+        vfs_path = args[0]
+
+    socket = lazy_import('socket')
+    select = lazy_import('select')
+    signal = lazy_import('signal')
+    gc = lazy_import('gc')
+    started = time.perf_counter()
+    try:
+        # Всё, что нужно сеансу, загружается один раз в родителе и наследуется детьми
+        base = None
+        if vfs_path:
+            base = open_base_image(vfs_path)
+            base.name_index()
+            base.subtree_totals()
+        for module_name in ('shlex', 'calendar'):
+            lazy_import(module_name)
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(unix_path)
+        listener.listen(SERVE_BACKLOG)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    # Объекты, созданные до fork, не трогает сборщик мусора - их страницы остаются общими
+    gc.freeze()
+    status_r, status_w = os.pipe()
+    status = os.fdopen(status_r, 'rb', buffering=0)
+    print(f"fork-server слушает {unix_path}, VFS: {vfs_path or 'по умолчанию'}, "
+          f"подготовка {(time.perf_counter() - started) * 1000:.1f} мс, тёплых процессов {warm}", flush=True)
+
+    forked = {}
+    # Тёплые процессы: запущены, но ещё не получили соединение
+    warming = set()
+    spawn_ms = []
+    wait_ms = []
+
+    def spawn(conn=None):
+        sys.stdout.flush()
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(status_r)
+                _fork_worker(listener, status_w, vfs_path, base, mounts, forked_at, conn)
+            except BaseException as e:
+                print(f"Ошибка в процессе {os.getpid()}: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        forked[pid] = forked_at
+        if conn is None:
+            warming.add(pid)
+        else:
+            conn.close()
+
+    # Остановка по SIGTERM так же, как по Ctrl+C: дети завершаются, сокет удаляется
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    pending = b''
+    try:
+        while True:
+            while len(warming) < warm:
+                spawn()
+            watched = [status] if warm else [status, listener]
+            readable, _, _ = select.select(watched, [], [], 0.5)
+            if listener in readable:
+                conn, _ = listener.accept()
+                spawn(conn)
+            if status in readable:
+                pending += status.read(4096)
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    event, pid, ms = line.decode().split()
+                    pid = int(pid)
+                    if event == 'ready':
+                        spawn_ms.append(float(ms))
+                        print(f"процесс {pid} готов за {ms} мс после fork", flush=True)
+                    else:
+                        warming.discard(pid)
+                        wait_ms.append(float(ms))
+                        print(f"сеанс в процессе {pid}: {ms} мс от подключения до запуска оболочки", flush=True)
+            while forked:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                forked.pop(pid, None)
+                warming.discard(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in forked:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        listener.close()
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        if spawn_ms:
+            print(f"Запуск процесса: в среднем {sum(spawn_ms) / len(spawn_ms):.3f} мс, "
+                  f"максимум {max(spawn_ms):.3f} мс, процессов {len(spawn_ms)}")
+        if wait_ms:
+            print(f"Сеансов {len(wait_ms)}: от подключения до оболочки в среднем "
+                  f"{sum(wait_ms) / len(wait_ms):.3f} мс, максимум {max(wait_ms):.3f} мс")
+
+
+def print_startup_profile(emulator: 'ShellEmulator', import_seconds: float, init_seconds: float):
+    """Время запуска по компонентам: импорт модуля, загрузка VFS, оболочка, сторонние команды"""
+    load_seconds = emulator.vfs.base.load_stats.get('load_seconds', 0.0)
+    print("Профиль запуска:")
+    print(f"  импорт main4: {import_seconds * 1000:.3f} мс")
+    print(f"  загрузка VFS: {load_seconds * 1000:.3f} мс")
+    print(f"  инициализация оболочки: {max(init_seconds - load_seconds, 0.0) * 1000:.3f} мс")
+    print("  импорт по требованию:")
+    for name, seconds in import_profile.items():
+        print(f"    {name}: {seconds * 1000:.3f} мс")
+    if emulator.commands.profile:
+        print("  сторонние команды (импорт при первом вызове):")
+    for name, seconds in emulator.commands.profile.items():
+        print(f"    {name}: {seconds * 1000:.3f} мс")
+
+
 def main():
     vfs_path = None
     script_path = None
+    mounts = None
+
+    if len(sys.argv) >= 2 and sys.argv[1] in ('pack', 'unpack', 'compact', 'build-vfs'):
+        run_image_tool(sys.argv[1:])
+        return
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench-script':
+        run_script_benchmark(sys.argv[2:])
+        return
+    if len(sys.argv) >= 2 and sys.argv[1] == 'batch':
+        run_batch(sys.argv[2:])
+        return
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        run_server(sys.argv[2:])
+        return
+    if len(sys.argv) >= 2 and sys.argv[1] == 'fork-server':
+        run_fork_server(sys.argv[2:])
+        return
+
+    args = sys.argv[1:]
+    quiet = '--quiet' in args
+    startup_profile = '--startup-profile' in args
+    flush_policy = None
+    for arg in [arg for arg in args if arg in ('--quiet', '--startup-profile') or arg.startswith(('--flush=', '--plugins='))]:
+        if arg.startswith('--plugins='):
+            try:
+                load_plugin_manifest(arg[10:])
+            except (OSError, ValueError) as e:
+                print(f"Ошибка чтения манифеста команд: {e}")
+                sys.exit(1)
+        if arg.startswith('--flush='):
+            flush_policy = arg[8:]
+            if flush_policy not in FLUSH_POLICIES:
+                print(f"Неизвестная политика сброса вывода: {flush_policy}")
+                print_usage()
+                sys.exit(1)
+        args.remove(arg)
+
+    if len(args) >= 2 and args[0] == '--mounts':
+        try:
+            vfs_path, mounts = load_manifest(args[1])
+        except (OSError, ValueError) as e:
+            print(f"Ошибка чтения манифеста: {e}")
+            sys.exit(1)
+        args = args[2:]
+        # Корневой образ из манифеста занимает место позиционного vfs_path
+        if vfs_path is not None:
+            args = [vfs_path] + args
 
-    if len(sys.argv) > 3:
+    if len(args) > 2:
         print("Слишком много аргументов")
         print_usage()
         sys.exit(1)
-    elif len(sys.argv) >= 2:
-        vfs_path = sys.argv[1]
-    if len(sys.argv) >= 3:
-        script_path = sys.argv[2]
+    elif len(args) >= 1:
+        vfs_path = args[0]
+    if len(args) >= 2:
+        script_path = args[1]
 
-    emulator = ShellEmulator(vfs_path, script_path)
+    started = time.perf_counter()
+    emulator = ShellEmulator(vfs_path, script_path, mounts, OutputSink(flush_policy=flush_policy), quiet)
+    if startup_profile:
+        init_seconds = time.perf_counter() - started
+        if script_path:
+            try:
+                emulator.run_script()
+            finally:
+                emulator.out.flush()
+        print_startup_profile(emulator, started - _import_started, init_seconds)
+        return
     emulator.run()
 
 